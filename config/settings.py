@@ -39,6 +39,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'users',
     'rest_framework',
@@ -82,7 +83,7 @@ WSGI_APPLICATION = 'config.wsgi.application'
 REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.CachedJWTAuthentication',
     )
 }
 
@@ -99,6 +100,42 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHE_LOCATION = os.getenv('CACHE_LOCATION')
+if CACHE_LOCATION:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_LOCATION,
+        }
+    }
+
+# Время жизни кэша ролей пользователя между запросами в секундах (0 - не кэшировать)
+USER_ROLES_CACHE_TIMEOUT = int(os.getenv('USER_ROLES_CACHE_TIMEOUT') or 0)
+
+# Время кэширования пользователя для аутентификации по JWT в кэше Django и в памяти процесса, в секундах.
+# Кэш включается только с общим для всех процессов Redis (CACHE_LOCATION), иначе сброс кэша после изменения
+# пользователя не дойдет до других процессов. Изменения доходят до других процессов с задержкой
+# до USER_AUTH_LOCAL_CACHE_TIMEOUT
+USER_AUTH_CACHE_TIMEOUT = int(os.getenv('USER_AUTH_CACHE_TIMEOUT') or 5 * 60) if CACHE_LOCATION else 0
+USER_AUTH_LOCAL_CACHE_TIMEOUT = int(os.getenv('USER_AUTH_LOCAL_CACHE_TIMEOUT') or 5)
+
+# Время входа копится в кэше и сохраняется в БД задачей flush_last_logins только с общим для всех процессов
+# Redis (CACHE_LOCATION), иначе воркер celery не увидит входы, записанные веб-процессом, и last_login пишется сразу
+LAST_LOGIN_BUFFERED = bool(CACHE_LOCATION)
+# Время хранения в кэше несохраненных входов пользователей в секундах и размер пачки при сохранении в БД
+LAST_LOGIN_BUFFER_TIMEOUT = int(os.getenv('LAST_LOGIN_BUFFER_TIMEOUT') or 24 * 60 * 60)
+LAST_LOGIN_FLUSH_BATCH_SIZE = int(os.getenv('LAST_LOGIN_FLUSH_BATCH_SIZE') or 1000)
+
+# Количество последних платежей в профиле и время кэширования итогов по платежам пользователя в секундах.
+# Итоги кэшируются только в общем Redis (CACHE_LOCATION), иначе сброс из воркера celery не дойдет до веб-процессов
+USER_RECENT_PAYMENTS = int(os.getenv('USER_RECENT_PAYMENTS') or 10)
+USER_PAYMENT_TOTALS_CACHE_TIMEOUT = (
+    int(os.getenv('USER_PAYMENT_TOTALS_CACHE_TIMEOUT') or 60 * 60) if CACHE_LOCATION else 0
+)
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -141,7 +178,9 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 AUTH_USER_MODEL = 'users.User'
 
 SIMPLE_JWT = {
-    'UPDATE_LAST_LOGIN': True
+    # last_login сохраняет LastLoginTokenObtainPairSerializer, см. LAST_LOGIN_BUFFERED
+    'UPDATE_LAST_LOGIN': False,
+    'TOKEN_OBTAIN_SERIALIZER': 'users.serializes.LastLoginTokenObtainPairSerializer'
 }
 
 EMAIL_HOST = os.getenv('EMAIL_HOST')
@@ -153,11 +192,65 @@ EMAIL_USE_SSL = os.getenv('EMAIL_USE_SSL') == 'True'
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL')
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND')
 
+# Окно в секундах, в течение которого изменения курса объединяются в одно уведомление подписчикам
+COURSE_UPDATE_NOTIFICATION_WINDOW = int(os.getenv('COURSE_UPDATE_NOTIFICATION_WINDOW') or 15 * 60)
+# Окно занимается ключом в общем кэше Redis (CACHE_LOCATION), без него - записью в БД, иначе каждый процесс
+# со своим кэшем в памяти запланирует свое уведомление
+COURSE_UPDATE_NOTIFICATION_CACHE_DEBOUNCE = bool(CACHE_LOCATION)
+
+# Количество получателей в одной пачке писем об обновлении курса
+COURSE_UPDATE_EMAIL_BATCH_SIZE = int(os.getenv('COURSE_UPDATE_EMAIL_BATCH_SIZE') or 500)
+
+# Количество пользователей, деактивируемых одним UPDATE в check_user_activity
+USER_ACTIVITY_BATCH_SIZE = int(os.getenv('USER_ACTIVITY_BATCH_SIZE') or 10000)
+
+# Создавать сессию оплаты stripe в фоне для всех запросов, а не только с заголовком Prefer: respond-async
+PAYMENT_CHECKOUT_ASYNC = os.getenv('PAYMENT_CHECKOUT_ASYNC') == 'True'
+
+# Таймауты в секундах, число повторов и размер пула соединений для запросов в stripe
+STRIPE_CONNECT_TIMEOUT = float(os.getenv('STRIPE_CONNECT_TIMEOUT') or 3)
+STRIPE_READ_TIMEOUT = float(os.getenv('STRIPE_READ_TIMEOUT') or 15)
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv('STRIPE_MAX_NETWORK_RETRIES') or 2)
+STRIPE_POOL_SIZE = int(os.getenv('STRIPE_POOL_SIZE') or 10)
+
+# Размыкатель цепи stripe: окно подсчета в секундах, минимум вызовов и доля ошибок в окне для размыкания,
+# время в секундах до пробного вызова и длительность вызова в секундах, который считается ошибкой
+STRIPE_BREAKER_WINDOW = int(os.getenv('STRIPE_BREAKER_WINDOW') or 30)
+STRIPE_BREAKER_MIN_CALLS = int(os.getenv('STRIPE_BREAKER_MIN_CALLS') or 5)
+STRIPE_BREAKER_FAILURE_RATE = float(os.getenv('STRIPE_BREAKER_FAILURE_RATE') or 0.5)
+STRIPE_BREAKER_RECOVERY_TIMEOUT = int(os.getenv('STRIPE_BREAKER_RECOVERY_TIMEOUT') or 30)
+STRIPE_BREAKER_SLOW_CALL = float(os.getenv('STRIPE_BREAKER_SLOW_CALL') or 5)
+
+# Сколько секунд хранится ответ на создание платежа для повторов с тем же Idempotency-Key
+# и на сколько секунд блокируется ключ на время обработки первого запроса
+PAYMENT_IDEMPOTENCY_TTL = int(os.getenv('PAYMENT_IDEMPOTENCY_TTL') or 24 * 60 * 60)
+PAYMENT_IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('PAYMENT_IDEMPOTENCY_LOCK_TIMEOUT') or 60)
+
+# Секрет для проверки подписи вебхуков stripe
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+
+# Через сколько секунд без вебхука статус платежа перепроверяется запросом в stripe
+PAYMENT_STATUS_STALE_AFTER = int(os.getenv('PAYMENT_STATUS_STALE_AFTER') or 60)
+
+# Размер страницы списка сессий stripe при сверке открытых платежей
+PAYMENT_RECONCILE_PAGE_SIZE = int(os.getenv('PAYMENT_RECONCILE_PAGE_SIZE') or 100)
+
+# Количество платежей, читаемых серверным курсором за раз при выгрузке
+PAYMENT_EXPORT_CHUNK_SIZE = int(os.getenv('PAYMENT_EXPORT_CHUNK_SIZE') or 2000)
+
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 CELERY_BEAT_SCHEDULE = {
     'check_user_activity': {
         'task': 'materials.tasks.check_user_activity',
         'schedule': datetime.timedelta(days=1)
+    },
+    'reconcile_pending_payments': {
+        'task': 'users.tasks.reconcile_pending_payments',
+        'schedule': datetime.timedelta(minutes=10)
+    },
+    'flush_last_logins': {
+        'task': 'users.tasks.flush_last_logins',
+        'schedule': datetime.timedelta(minutes=1)
     }
 }
 
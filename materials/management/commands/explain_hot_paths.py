@@ -0,0 +1,151 @@
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+from rest_framework.test import APIRequestFactory
+
+from materials.models import Course, Lesson, Subscription
+from materials.search import build_search_query, search_materials, update_search_vector
+from materials.tasks import get_inactive_users
+from materials.views import CourseViewSet, LessonListAPIView, SubscriptionListAPIView
+from users.models import User, Payment
+from users.views import PaymentViewSet
+
+INDEX_NODES = ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan')
+
+
+class Command(BaseCommand):
+    help = 'Выводит EXPLAIN ANALYZE основных выборок materials.views и users.views (тестовые данные откатываются)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=10_000,
+                            help='Количество курсов в тестовых данных (0 - не создавать)')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Команда работает только с PostgreSQL')
+        with transaction.atomic():
+            if options['seed']:
+                self.seed(options['seed'])
+            owner = User.objects.filter(course__isnull=False).order_by('pk').first()
+            if owner is None:
+                raise CommandError('Нет данных для замера, запустите команду с --seed')
+            failed = []
+            for name, queryset in self.get_hot_paths(owner):
+                plan = queryset.explain(analyze=True)
+                uses_index = any(node in plan for node in INDEX_NODES)
+                if not uses_index:
+                    failed.append(name)
+                self.stdout.write(f'=== {name}: {"index" if uses_index else "SEQ SCAN"}')
+                self.stdout.write(plan)
+            transaction.set_rollback(True)
+        if failed:
+            self.stdout.write(self.style.WARNING(f'Без индекса: {", ".join(failed)}'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Все выборки используют индексы'))
+
+    def get_view(self, view_class, user, query=None, **initkwargs):
+        """Создает представление с запросом от имени пользователя"""
+        if 'action' in initkwargs:
+            initkwargs['action_map'] = {'get': initkwargs['action']}
+        view = view_class(**initkwargs)
+        view.args, view.kwargs, view.format_kwarg = (), {}, None
+        view.request = view.initialize_request(APIRequestFactory().get('/', query or {}))
+        view.request.user = user
+        return view
+
+    def get_hot_paths(self, owner):
+        course_view = self.get_view(CourseViewSet, owner, action='list')
+        lesson_view = self.get_view(LessonListAPIView, owner)
+        course = Course.objects.filter(user=owner).first()
+        lesson = Lesson.objects.filter(course=course).first()
+        yield 'course list', course_view.get_queryset()[:5]
+        yield 'course list (cursor)', course_view.get_queryset().order_by('-id')[:6]
+        yield 'course list (last_update)', course_view.get_scoped_queryset().order_by('-last_update')[:5]
+        yield 'course lessons prefetch', Lesson.objects.filter(course__in=[course])
+        yield 'lesson list', lesson_view.get_queryset()[:5]
+        yield 'lesson list (last_update)', lesson_view.get_queryset().order_by('-last_update')[:5]
+        yield 'subscription list', self.get_view(SubscriptionListAPIView, owner).get_queryset()[:5]
+        yield 'subscribers fan-out', Subscription.objects.filter(course=course).values_list('user__email', flat=True)
+        yield 'inactive users', get_inactive_users().values('pk')
+        query = build_search_query('course 12')
+        yield 'materials search', search_materials(
+            query, Course.objects.filter(user=owner), Lesson.objects.filter(user=owner)
+        )[:10]
+        yield 'materials search (moderator)', search_materials(query, Course.objects.all(), Lesson.objects.all())[:10]
+        for query in ({'course': course.pk, 'ordering': '-date'},
+                      {'lesson': lesson.pk, 'ordering': '-date'},
+                      {'payment_method': 'card', 'ordering': '-date'},
+                      {'ordering': '-date'},
+                      {}):
+            view = self.get_view(PaymentViewSet, owner, query, action='list')
+            name = 'payment list ' + (', '.join(f'{key}={value}' for key, value in query.items()) or 'default')
+            yield name, view.filter_queryset(view.get_queryset())[:20]
+
+    def seed(self, courses):
+        """Создает тестовые данные: пользователей, курсы, уроки, подписки и платежи"""
+        users = max(courses // 10, 1)
+        quote = connection.ops.quote_name
+        user_table = quote(User._meta.db_table)
+        course_table = quote(Course._meta.db_table)
+        lesson_table = quote(Lesson._meta.db_table)
+        subscription_table = quote(Subscription._meta.db_table)
+        payment_table = quote(Payment._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {user_table} (password, last_login, is_superuser, first_name, last_name,
+                                          is_staff, is_active, date_joined, email)
+                SELECT '', now() - (i %% 40) * interval '1 day' * (i %% 20 = 0)::int, false, '', '', false, true,
+                       now() - (i %% 365) * interval '1 day', 'explain-user-' || i || '@example.com'
+                FROM generate_series(1, %(users)s) AS i
+                """,
+                {'users': users}
+            )
+            cursor.execute(f"SELECT min(id) FROM {user_table} WHERE email LIKE 'explain-user-%%'")
+            first_user = cursor.fetchone()[0]
+            cursor.execute(
+                f"""
+                INSERT INTO {course_table} (name, description, user_id, last_update)
+                SELECT 'course ' || i, repeat('description ', 50), %(first_user)s + i %% %(users)s,
+                       now() - i * interval '1 minute'
+                FROM generate_series(1, %(courses)s) AS i
+                """,
+                {'first_user': first_user, 'users': users, 'courses': courses}
+            )
+            cursor.execute(f"SELECT min(id) FROM {course_table} WHERE user_id >= %s", [first_user])
+            first_course = cursor.fetchone()[0]
+            cursor.execute(
+                f"""
+                INSERT INTO {lesson_table} (name, description, video_link, course_id, user_id, last_update)
+                SELECT 'lesson ' || i, repeat('description ', 50), 'https://www.youtube.com/' || i,
+                       %(first_course)s + i %% %(courses)s, %(first_user)s + (i %% %(courses)s + 1) %% %(users)s,
+                       now() - i * interval '1 minute'
+                FROM generate_series(1, %(courses)s * 10) AS i
+                """,
+                {'first_course': first_course, 'first_user': first_user, 'users': users, 'courses': courses}
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO {subscription_table} (user_id, course_id)
+                SELECT %(first_user)s + i %% %(users)s, %(first_course)s + (i / %(users)s) %% %(courses)s
+                FROM generate_series(1, %(courses)s * 5) AS i
+                ON CONFLICT DO NOTHING
+                """,
+                {'first_course': first_course, 'first_user': first_user, 'users': users, 'courses': courses}
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO {payment_table} (summ, user_id, date, course_id, lesson_id, payment_method, checkout_status)
+                SELECT 1000 + i %% 10000, %(first_user)s + i %% %(users)s, now() - i * interval '1 minute',
+                       CASE WHEN i %% 2 = 0 THEN %(first_course)s + i %% %(courses)s END,
+                       CASE WHEN i %% 2 = 1 THEN l.min_id + i %% (%(courses)s * 10) END,
+                       CASE WHEN i %% 3 = 0 THEN 'cash' ELSE 'card' END, 'created'
+                FROM generate_series(1, %(courses)s * 10) AS i,
+                     (SELECT min(id) AS min_id FROM {lesson_table} WHERE course_id >= %(first_course)s) AS l
+                """,
+                {'first_course': first_course, 'first_user': first_user, 'users': users, 'courses': courses}
+            )
+            update_search_vector(Course.objects.filter(pk__gte=first_course))
+            update_search_vector(Lesson.objects.filter(course_id__gte=first_course))
+            for table in (user_table, course_table, lesson_table, subscription_table, payment_table):
+                cursor.execute(f'ANALYZE {table}')
+        self.stdout.write(f'Созданы тестовые данные: {users} пользователей, {courses} курсов')
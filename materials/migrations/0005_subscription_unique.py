@@ -0,0 +1,29 @@
+# Generated by Django 4.2 on 2026-10-18 08:11
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def delete_duplicate_subscriptions(apps, schema_editor):
+    Subscription = apps.get_model('materials', 'Subscription')
+    keep_ids = Subscription.objects.values('user', 'course').annotate(keep_id=Min('id')).values('keep_id')
+    Subscription.objects.exclude(id__in=keep_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0004_course_last_update_lesson_last_update'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_subscriptions, migrations.RunPython.noop),
+        migrations.AlterModelOptions(
+            name='subscription',
+            options={'verbose_name': 'Подписка', 'verbose_name_plural': 'Подписки'},
+        ),
+        migrations.AddConstraint(
+            model_name='subscription',
+            constraint=models.UniqueConstraint(fields=('user', 'course'), name='unique_subscription_user_course'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2 on 2026-10-18 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0005_subscription_unique'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='course',
+            index=models.Index(fields=['user', '-last_update'], name='course_user_last_update_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['user', '-last_update'], name='lesson_user_last_update_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['course', '-last_update'], name='lesson_course_last_update_idx'),
+        ),
+    ]
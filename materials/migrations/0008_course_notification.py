@@ -0,0 +1,25 @@
+# Generated by Django 4.2 on 2026-10-18 09:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0007_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourseNotification',
+            fields=[
+                ('course', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='materials.course', verbose_name='Курс')),
+                ('scheduled_until', models.DateTimeField(verbose_name='Уведомление запланировано до')),
+            ],
+            options={
+                'verbose_name': 'Уведомление об обновлении курса',
+                'verbose_name_plural': 'Уведомления об обновлении курсов',
+            },
+        ),
+    ]
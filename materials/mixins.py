@@ -0,0 +1,114 @@
+import datetime
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+
+class ConditionalGetMixin:
+    """
+    Отвечает 304 Not Modified на условные запросы (If-None-Match / If-Modified-Since)
+    к retrieve и list. Состояние объекта или списка вычисляется одним легким запросом
+    по last_update без сериализации.
+    """
+    # Поля, загружаемые для проверки прав доступа к объекту
+    conditional_fields = ('user', 'last_update')
+    # If-Modified-Since учитывается, только если любое изменение ответа отражается в last_update
+    honor_if_modified_since = False
+
+    def get_conditional_queryset(self):
+        """Возвращает выборку, по которой вычисляется состояние"""
+        return self.filter_queryset(self.get_queryset())
+
+    def get_object_state_annotations(self):
+        """Возвращает дополнительные аннотации состояния объекта"""
+        return {}
+
+    def get_list_state_aggregates(self):
+        """Возвращает дополнительные агрегаты состояния списка"""
+        return {}
+
+    def get_object_state(self):
+        """Возвращает состояние запрошенного объекта или None, если объект не найден"""
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        annotations = self.get_object_state_annotations()
+        obj = self.get_conditional_queryset().filter(
+            **{self.lookup_field: self.kwargs[lookup_url_kwarg]}
+        ).only(*self.conditional_fields).annotate(**annotations).first()
+        if obj is None:
+            return None
+        self.check_object_permissions(self.request, obj)
+        state = {'pk': obj.pk, 'last_update': obj.last_update}
+        for name in annotations:
+            state[name] = getattr(obj, name)
+        return state
+
+    def get_list_state(self):
+        """Возвращает состояние списка: количество, максимальный id и время последнего обновления"""
+        return self.get_conditional_queryset().aggregate(
+            count=Count('pk', distinct=True),
+            max_pk=Max('pk'),
+            last_update=Max('last_update'),
+            **self.get_list_state_aggregates()
+        )
+
+    def get_validators(self, state):
+        """Возвращает ETag и время последнего изменения для состояния"""
+        request = self.request
+        fingerprint = repr((
+            sorted(state.items()),
+            request.user.pk,
+            sorted(request.query_params.lists()),
+            getattr(request, 'accepted_media_type', None),
+        ))
+        etag = quote_etag(hashlib.md5(fingerprint.encode()).hexdigest())
+        updates = [value for value in state.values() if isinstance(value, datetime.datetime)]
+        last_modified = int(max(updates).timestamp()) if updates else None
+        return etag, last_modified
+
+    def conditional_response(self, state, handler, request, *args, **kwargs):
+        """Возвращает 304, если состояние не изменилось, иначе ответ обработчика с валидаторами"""
+        if state is None:
+            return handler(request, *args, **kwargs)
+        etag, last_modified = self.get_validators(state)
+        response = get_conditional_response(
+            request,
+            etag=etag,
+            last_modified=last_modified if self.honor_if_modified_since else None
+        )
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if 200 <= response.status_code < 300 or response.status_code == 304:
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(self.get_object_state(), super().retrieve, request, *args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(self.get_list_state(), super().list, request, *args, **kwargs)
+
+
+class SparseFieldsMixin:
+    """Загружает из БД только те поля модели, которые попадут в ответ на GET-запрос с ?fields="""
+    # Поля, которые нужны для проверки прав доступа к объекту
+    sparse_required_fields = ('user',)
+    # Служебные поля модели, которые не выводятся в ответе и не загружаются из БД
+    sparse_excluded_fields = ()
+
+    def get_response_fields(self):
+        """Возвращает поля сериализатора, которые попадут в ответ"""
+        return self.get_serializer().fields
+
+    def only_response_fields(self, queryset, response_fields):
+        """Ограничивает выборку полями модели, нужными для ответа"""
+        if self.request.method != 'GET':
+            return queryset
+        if 'fields' not in self.request.query_params:
+            return queryset.defer(*self.sparse_excluded_fields) if self.sparse_excluded_fields else queryset
+        model_fields = {field.name for field in queryset.model._meta.concrete_fields}
+        sources = {field.source for field in response_fields.values()} | set(self.sparse_required_fields)
+        return queryset.only(*(sources & model_fields))
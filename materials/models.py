@@ -1,5 +1,7 @@
 from django.conf import settings
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.db import connections, models
 
 NULLABLE = {'null': True, 'blank': True}
 # Create your models here.
@@ -11,6 +13,7 @@ class Course(models.Model):
     preview = models.ImageField(upload_to='courses/', verbose_name='Превью', **NULLABLE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name='Пользователь', **NULLABLE)
     last_update = models.DateTimeField(verbose_name='Дата и время последнего обновления', **NULLABLE)
+    search_vector = SearchVectorField(verbose_name='Поисковый вектор', editable=False, **NULLABLE)
 
     def __str__(self):
         return self.name
@@ -18,6 +21,20 @@ class Course(models.Model):
     class Meta:
         verbose_name = 'Курс'
         verbose_name_plural = 'Курсы'
+        indexes = [
+            models.Index(fields=['user', '-last_update'], name='course_user_last_update_idx'),
+            GinIndex(fields=['search_vector'], name='course_search_vector_idx'),
+        ]
+
+
+class CourseNotification(models.Model):
+    """Время, до которого уведомление об обновлении курса уже запланировано, когда нет общего кэша"""
+    course = models.OneToOneField(Course, on_delete=models.CASCADE, primary_key=True, verbose_name='Курс')
+    scheduled_until = models.DateTimeField(verbose_name='Уведомление запланировано до')
+
+    class Meta:
+        verbose_name = 'Уведомление об обновлении курса'
+        verbose_name_plural = 'Уведомления об обновлении курсов'
 
 
 class Lesson(models.Model):
@@ -28,6 +45,7 @@ class Lesson(models.Model):
     course = models.ForeignKey(Course, on_delete=models.CASCADE, verbose_name='Курс')
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name='Пользователь', **NULLABLE)
     last_update = models.DateTimeField(verbose_name='Дата и время последнего обновления', **NULLABLE)
+    search_vector = SearchVectorField(verbose_name='Поисковый вектор', editable=False, **NULLABLE)
 
     def __str__(self):
         return self.name
@@ -35,8 +53,54 @@ class Lesson(models.Model):
     class Meta:
         verbose_name = 'Урок'
         verbose_name_plural = 'Уроки'
+        indexes = [
+            models.Index(fields=['user', '-last_update'], name='lesson_user_last_update_idx'),
+            models.Index(fields=['course', '-last_update'], name='lesson_course_last_update_idx'),
+            GinIndex(fields=['search_vector'], name='lesson_search_vector_idx'),
+        ]
+
+
+class SubscriptionManager(models.Manager):
+    def toggle(self, user_id, course_id):
+        """
+        Добавляет подписку на курс или удаляет существующую одним запросом к БД.
+        Возвращает True, если пользователь подписан, False, если отписан, и None, если курса нет.
+        """
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        course_table = connection.ops.quote_name(Course._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH deleted AS (
+                    DELETE FROM {table} WHERE user_id = %s AND course_id = %s RETURNING id
+                ), inserted AS (
+                    INSERT INTO {table} (user_id, course_id)
+                    SELECT %s, id FROM {course_table}
+                    WHERE id = %s AND NOT EXISTS (SELECT 1 FROM deleted)
+                    ON CONFLICT (user_id, course_id) DO NOTHING
+                    RETURNING id
+                )
+                SELECT EXISTS (SELECT 1 FROM deleted),
+                       EXISTS (SELECT 1 FROM {course_table} WHERE id = %s)
+                """,
+                [user_id, course_id, user_id, course_id, course_id]
+            )
+            deleted, course_exists = cursor.fetchone()
+        if not course_exists:
+            return None
+        return not deleted
 
 
 class Subscription(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name='Пользователь')
     course = models.ForeignKey(Course, on_delete=models.CASCADE, verbose_name='Курс')
+
+    objects = SubscriptionManager()
+
+    class Meta:
+        verbose_name = 'Подписка'
+        verbose_name_plural = 'Подписки'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'course'], name='unique_subscription_user_course'),
+        ]
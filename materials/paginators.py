@@ -1,7 +1,58 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+
+class MaterialsCursorPaginator(CursorPagination):
+    """Постраничный вывод по курсору (keyset) без COUNT(*) и OFFSET"""
+    page_size = 5
+    page_size_query_param = 'page_size'
+    max_page_size = 50
+    ordering = '-id'
 
 
 class MaterialsPaginator(PageNumberPagination):
+    """
+    Постраничный вывод по номеру страницы или по курсору.
+    Режим по курсору включается параметром ?pagination=cursor, наличием параметра cursor
+    или атрибутом представления pagination_mode = 'cursor'.
+    """
     page_size = 5
     page_size_query_param = 'page_size'
     max_page_size = 50
+    pagination_mode_query_param = 'pagination'
+    cursor_paginator_class = MaterialsCursorPaginator
+    cursor_paginator = None
+
+    def use_cursor(self, request, view=None):
+        """Определяет, нужно ли выводить страницы по курсору"""
+        if self.cursor_paginator_class.cursor_query_param in request.query_params:
+            return True
+        mode = request.query_params.get(self.pagination_mode_query_param, getattr(view, 'pagination_mode', 'page'))
+        return mode == 'cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.use_cursor(request, view):
+            self.cursor_paginator = self.cursor_paginator_class()
+            return self.cursor_paginator.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def get_html_context(self):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_html_context()
+        return super().get_html_context()
+
+    def to_html(self):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.to_html()
+        return super().to_html()
+
+
+class SearchPaginator(PageNumberPagination):
+    """Постраничный вывод результатов поиска, отсортированных по релевантности"""
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 50
@@ -0,0 +1,49 @@
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db.models import CharField, F, IntegerField, Value
+
+SEARCH_CONFIG = 'russian'
+SEARCH_MAX_TERMS = 10
+SEARCH_TERM_RE = re.compile(r'\w+')
+
+
+def get_search_vector():
+    """Возвращает выражение поискового вектора: название весит больше описания"""
+    return SearchVector('name', weight='A', config=SEARCH_CONFIG) + \
+        SearchVector('description', weight='B', config=SEARCH_CONFIG)
+
+
+def update_search_vector(queryset):
+    """Пересчитывает поисковый вектор одним UPDATE, например после bulk_create, который не вызывает сигналы"""
+    return queryset.update(search_vector=get_search_vector())
+
+
+def build_search_query(text):
+    """
+    Строит запрос с поиском по префиксу каждого слова: "джанг сер" -> "джанг:* & сер:*".
+    Возвращает None, если в строке нет слов
+    """
+    terms = SEARCH_TERM_RE.findall(text)[:SEARCH_MAX_TERMS]
+    if not terms:
+        return None
+    return SearchQuery(' & '.join(f'{term}:*' for term in terms), search_type='raw', config=SEARCH_CONFIG)
+
+
+def search_materials(query, courses=None, lessons=None):
+    """Объединяет найденные курсы и уроки в одну выборку, отсортированную по релевантности"""
+    rank = SearchRank(F('search_vector'), query)
+    results = []
+    if courses is not None:
+        results.append(courses.filter(search_vector=query).annotate(
+            type=Value('course', output_field=CharField()),
+            course_ref=Value(None, output_field=IntegerField()),
+            rank=rank,
+        ).values('type', 'id', 'name', 'course_ref', 'rank'))
+    if lessons is not None:
+        results.append(lessons.filter(search_vector=query).annotate(
+            type=Value('lesson', output_field=CharField()),
+            course_ref=F('course_id'),
+            rank=rank,
+        ).values('type', 'id', 'name', 'course_ref', 'rank'))
+    return results[0].union(*results[1:], all=True).order_by('-rank', 'type', 'id')
@@ -4,25 +4,97 @@ from materials.models import Course, Lesson, Subscription
 from materials.validators import VideoLinkValidator
 
 
-class LessonSerializer(serializers.ModelSerializer):
+def parse_list_param(query_params, name):
+    """Возвращает множество значений параметра вида ?fields=id,name или None, если параметра нет"""
+    if name not in query_params:
+        return None
+    return {value.strip() for value in query_params[name].split(',') if value.strip()}
+
+
+class DynamicFieldsMixin:
+    """
+    Оставляет в ответе на GET-запрос только поля из параметра ?fields=.
+    Поля из expandable_fields выводятся, если перечислены в ?fields= или ?expand=,
+    а без обоих параметров выводятся все поля.
+    """
+    expandable_fields = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None or request.method != 'GET':
+            return
+        fields = parse_list_param(request.query_params, 'fields')
+        expand = parse_list_param(request.query_params, 'expand')
+        if fields is not None:
+            allowed = fields | (expand or set()) | {'id'}
+        elif expand is not None:
+            allowed = (set(self.fields) - set(self.expandable_fields)) | expand
+        else:
+            return
+        for name in set(self.fields) - allowed:
+            self.fields.pop(name)
+
+
+class LessonSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Lesson
-        fields = '__all__'
+        exclude = ('search_vector',)
         validators = [VideoLinkValidator(field='video_link')]
 
 
-class CourseSerializer(serializers.ModelSerializer):
+class CourseSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     lessons_count = serializers.SerializerMethodField(read_only=True)
     lessons = LessonSerializer(many=True, source='lesson_set', read_only=True)
     is_subscribed = serializers.SerializerMethodField(read_only=True)
+    expandable_fields = ('lessons',)
 
     class Meta:
         model = Course
-        fields = '__all__'
+        exclude = ('search_vector',)
 
     def get_lessons_count(self, instance):
+        if hasattr(instance, 'lessons_count'):
+            return instance.lessons_count
         return instance.lesson_set.all().count()
 
     def get_is_subscribed(self, instance):
+        if hasattr(instance, 'is_subscribed'):
+            return instance.is_subscribed
         return Subscription.objects.filter(user=self.context['request'].user, course=instance.pk).exists()
 
+
+class LessonBulkItemSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Lesson
+        fields = ('name', 'description', 'video_link')
+        validators = [VideoLinkValidator(field='video_link')]
+
+
+class LessonBulkCreateSerializer(serializers.Serializer):
+    course = serializers.PrimaryKeyRelatedField(queryset=Course.objects.all())
+    lessons = LessonBulkItemSerializer(many=True, allow_empty=False, max_length=100)
+
+    def validate_course(self, value):
+        if value.user_id != self.context['request'].user.pk:
+            raise serializers.ValidationError('Добавлять уроки можно только в свой курс')
+        return value
+
+
+class SubscriptionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Subscription
+        fields = ('id', 'course')
+
+
+class SubscriptionBulkSerializer(serializers.Serializer):
+    subscribe = serializers.ListField(child=serializers.IntegerField(), max_length=100, required=False)
+    unsubscribe = serializers.ListField(child=serializers.IntegerField(), max_length=100, required=False)
+
+
+class SearchResultSerializer(serializers.Serializer):
+    type = serializers.CharField()
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    course = serializers.IntegerField(source='course_ref', allow_null=True)
+    rank = serializers.FloatField()
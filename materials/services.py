@@ -0,0 +1,61 @@
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from materials.models import CourseNotification
+from materials.tasks import update_course_email
+
+
+def get_notification_key(course_id):
+    """Возвращает ключ, блокирующий повторное планирование уведомления по курсу"""
+    return f'course_update_notification:{course_id}'
+
+
+def claim_notification(course_id, window):
+    """
+    Занимает окно уведомления по курсу ключом в общем кэше или условным UPDATE/INSERT в БД.
+    Возвращает True только одному из параллельных процессов
+    """
+    if settings.COURSE_UPDATE_NOTIFICATION_CACHE_DEBOUNCE:
+        return cache.add(get_notification_key(course_id), True, timeout=window)
+    now = timezone.now()
+    scheduled_until = now + datetime.timedelta(seconds=window)
+    if CourseNotification.objects.filter(course_id=course_id, scheduled_until__lte=now).update(
+        scheduled_until=scheduled_until
+    ):
+        return True
+    _, created = CourseNotification.objects.get_or_create(
+        course_id=course_id, defaults={'scheduled_until': scheduled_until}
+    )
+    return created
+
+
+def release_notification(course_id):
+    """Освобождает окно уведомления, если задачу не удалось поставить в очередь"""
+    if settings.COURSE_UPDATE_NOTIFICATION_CACHE_DEBOUNCE:
+        cache.delete(get_notification_key(course_id))
+    else:
+        CourseNotification.objects.filter(course_id=course_id).delete()
+
+
+def schedule_course_update_notification(course_id):
+    """
+    Планирует уведомление подписчиков об обновлении курса после фиксации транзакции.
+    Все изменения курса в пределах окна COURSE_UPDATE_NOTIFICATION_WINDOW
+    объединяются в одну отложенную задачу.
+    """
+    window = settings.COURSE_UPDATE_NOTIFICATION_WINDOW
+
+    def enqueue():
+        if not claim_notification(course_id, window):
+            return
+        try:
+            update_course_email.apply_async((course_id,), countdown=window)
+        except Exception:
+            release_notification(course_id)
+            raise
+
+    transaction.on_commit(enqueue)
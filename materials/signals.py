@@ -0,0 +1,16 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from materials.models import Course, Lesson
+from materials.search import update_search_vector
+
+SEARCH_FIELDS = {'name', 'description'}
+
+
+@receiver(post_save, sender=Course)
+@receiver(post_save, sender=Lesson)
+def update_search_vector_on_save(sender, instance, update_fields=None, **kwargs):
+    """Пересчитывает поисковый вектор при изменении названия или описания"""
+    if update_fields is not None and not SEARCH_FIELDS & set(update_fields):
+        return
+    update_search_vector(sender.objects.filter(pk=instance.pk))
@@ -1,36 +1,115 @@
 import datetime
+import logging
+import time
+from itertools import islice
 
 from celery import shared_task
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Max, Min, Q
 
-from materials.models import Subscription
+from materials.models import Course, Subscription
+from users.authentication import invalidate_all_user_auth
+from users.last_login import flush_last_login_buffer
 from users.models import User
 
+logger = logging.getLogger(__name__)
+
+# Сколько секунд check_user_activity ждет окончания сброса входов, запущенного в другом процессе
+USER_ACTIVITY_FLUSH_WAIT = 60
+
+
+def iter_batches(iterable, size):
+    """Разбивает итерируемый объект на списки фиксированного размера"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
 
 @shared_task
-def update_course_email(course):
-    subscriptions = Subscription.objects.filter(course=course)
-    user_list = [subs.user.email for subs in subscriptions]
-    send_mail(
-        subject='Обновление курса!',
-        message=f'Для курса {course.name} вышло обновление. Зайдите и посмотрите сейчас!',
-        from_email=settings.EMAIL_HOST_USER,
-        recipient_list=user_list,
-        fail_silently=True
+def update_course_email(course_id):
+    """Рассылает подписчикам курса уведомление об обновлении пачками фиксированного размера"""
+    course = Course.objects.filter(pk=course_id).only('name').first()
+    if course is None:
+        return None
+    started = time.monotonic()
+    batch_size = settings.COURSE_UPDATE_EMAIL_BATCH_SIZE
+    emails = Subscription.objects.filter(
+        course_id=course_id,
+        user__is_active=True
+    ).values_list('user__email', flat=True).iterator(chunk_size=batch_size)
+    recipients = batches = 0
+    for batch in iter_batches(emails, batch_size):
+        send_course_update_batch.delay(course.name, batch)
+        recipients += len(batch)
+        batches += 1
+    elapsed = time.monotonic() - started
+    logger.info('Курс %s: %s получателей в %s пачках поставлено в очередь за %.3f с',
+                course_id, recipients, batches, elapsed)
+    return {'course': course_id, 'recipients': recipients, 'batches': batches, 'seconds': elapsed}
+
+
+@shared_task(autoretry_for=(OSError,), retry_backoff=True, max_retries=5)
+def send_course_update_batch(course_name, recipient_list):
+    """Отправляет пачку писем об обновлении курса через одно SMTP-соединение"""
+    started = time.monotonic()
+    with get_connection() as connection:
+        messages = [
+            EmailMessage(
+                subject='Обновление курса!',
+                body=f'Для курса {course_name} вышло обновление. Зайдите и посмотрите сейчас!',
+                from_email=settings.EMAIL_HOST_USER,
+                to=[email],
+                connection=connection
+            )
+            for email in recipient_list
+        ]
+        sent = connection.send_messages(messages)
+    elapsed = time.monotonic() - started
+    logger.info('Отправлено %s писем об обновлении курса за %.3f с (%.1f писем/с)',
+                sent, elapsed, sent / elapsed if elapsed else sent)
+    return {'sent': sent, 'seconds': elapsed}
+
+
+def get_inactive_users(today=None):
+    """Возвращает активных пользователей, не заходивших (или не заходивших после регистрации) больше 30 дней"""
+    today = today or datetime.date.today()
+    threshold = datetime.datetime.combine(
+        today - datetime.timedelta(days=30), datetime.time.min, tzinfo=datetime.timezone.utc
+    )
+    return User.objects.filter(is_active=True).filter(
+        Q(last_login__lt=threshold) | Q(last_login__isnull=True, date_joined__lt=threshold)
     )
 
 
 @shared_task
-def check_user_activity():
-    users = User.objects.filter(is_active=True)
-    today = datetime.date.today()
-    for user in users:
-        if user.last_login:
-            if today - user.last_login.date() > datetime.timedelta(days=30):
-                user.is_active = False
-                user.save()
-        else:
-            if today - user.date_joined.date() > datetime.timedelta(days=30):
-                user.is_active = False
-                user.save()
+def check_user_activity(dry_run=False, batch_size=None):
+    """Деактивирует неактивных пользователей пачками UPDATE по диапазонам первичного ключа"""
+    started = time.monotonic()
+    # Сначала сохраняем отложенные входы, чтобы не деактивировать только что входивших пользователей
+    if settings.LAST_LOGIN_BUFFERED and flush_last_login_buffer(wait=USER_ACTIVITY_FLUSH_WAIT) is None:
+        result = {'found': 0, 'deactivated': 0, 'batches': 0, 'dry_run': dry_run, 'skipped': True,
+                  'seconds': time.monotonic() - started}
+        logger.warning('Проверка активности пользователей пропущена: не дождались сохранения входов %s', result)
+        return result
+    inactive_users = get_inactive_users()
+    if dry_run:
+        result = {'found': inactive_users.count(), 'deactivated': 0, 'batches': 0, 'dry_run': True}
+    else:
+        batch_size = batch_size or settings.USER_ACTIVITY_BATCH_SIZE
+        bounds = inactive_users.aggregate(min_pk=Min('pk'), max_pk=Max('pk'))
+        deactivated = batches = 0
+        if bounds['min_pk'] is not None:
+            for start in range(bounds['min_pk'], bounds['max_pk'] + 1, batch_size):
+                deactivated += inactive_users.filter(
+                    pk__gte=start,
+                    pk__lt=start + batch_size
+                ).update(is_active=False)
+                batches += 1
+        if deactivated:
+            # UPDATE не вызывает сигналы, поэтому сбрасываем кэш аутентификации целиком
+            invalidate_all_user_auth()
+        result = {'found': deactivated, 'deactivated': deactivated, 'batches': batches, 'dry_run': False}
+    result['seconds'] = time.monotonic() - started
+    logger.info('Проверка активности пользователей: %s', result)
+    return result
@@ -1,8 +1,20 @@
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase
 
-from materials.models import Course, Lesson
+from config.celery import app as celery_app
+from materials.models import Course, CourseNotification, Lesson, Subscription
+from materials.tasks import update_course_email
 from users.models import User
 
 
@@ -344,3 +356,435 @@ class CourseTestCase(APITestCase):
             response.status_code,
             status.HTTP_204_NO_CONTENT
         )
+
+
+class CourseQueryCountTestCase(APITestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(email='test@test.com')
+        for i in range(10):
+            course = Course.objects.create(name=f'course {i}', description='description', user=self.user)
+            for j in range(3):
+                Lesson.objects.create(
+                    name=f'lesson {j}',
+                    description='description',
+                    video_link='https://www.youtube.com/test_video_link',
+                    course=course,
+                    user=self.user
+                )
+            if i % 2:
+                Subscription.objects.create(user=self.user, course=course)
+        self.client.force_authenticate(user=self.user)
+
+    def test_list_course_query_count(self):
+        """Количество запросов к БД не зависит от размера страницы"""
+        query_counts = []
+        for page_size in (1, 10):
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get('/course/', {'page_size': page_size})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(response.json()['results']), page_size)
+            query_counts.append(len(context.captured_queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+        results = response.json()['results']
+        for course in results:
+            self.assertEqual(course['lessons_count'], 3)
+            self.assertEqual(len(course['lessons']), 3)
+        self.assertEqual(sum(course['is_subscribed'] for course in results), 5)
+
+
+class CursorPaginationTestCase(APITestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(email='test@test.com')
+        self.courses = [
+            Course.objects.create(name=f'course {i}', description='description', user=self.user) for i in range(7)
+        ]
+        self.client.force_authenticate(user=self.user)
+
+    def test_cursor_pagination(self):
+        """Тестирование вывода курсов по курсору без подсчета количества"""
+        response = self.client.get('/course/', {'pagination': 'cursor', 'page_size': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertNotIn('count', data)
+        self.assertIsNone(data['previous'])
+        self.assertEqual([course['id'] for course in data['results']], [course.pk for course in self.courses[:3:-1]])
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(data['next'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse([query for query in context.captured_queries if 'COUNT(*)' in query['sql']])
+        self.assertFalse([query for query in context.captured_queries if 'OFFSET' in query['sql']])
+        self.assertEqual([course['id'] for course in response.json()['results']],
+                         [course.pk for course in self.courses[3:0:-1]])
+
+    def test_page_number_pagination(self):
+        """Постраничный вывод по номеру страницы остается режимом по умолчанию"""
+        response = self.client.get('/course/', {'page': 2, 'page_size': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['count'], 7)
+        self.assertEqual(len(response.json()['results']), 3)
+
+
+class ConditionalGetTestCase(APITestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(email='test@test.com')
+        self.course = Course.objects.create(
+            name='test course', description='test description', user=self.user, last_update=timezone.now()
+        )
+        self.lesson = Lesson.objects.create(
+            name="test lesson",
+            description="test description",
+            video_link="https://www.youtube.com/test_video_link",
+            course=self.course,
+            user=self.user,
+            last_update=timezone.now()
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_course_not_modified(self):
+        """Тестирование ответа 304 для неизмененного курса"""
+        url = reverse('materials:course-detail', args=(self.course.pk,))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(len(context.captured_queries), 2)
+
+        Subscription.objects.create(user=self.user, course=self.course)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.json()['is_subscribed'])
+        etag = response['ETag']
+
+        Lesson.objects.filter(pk=self.lesson.pk).update(last_update=timezone.now() + timezone.timedelta(seconds=1))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_course_list_not_modified(self):
+        """Тестирование ответа 304 для неизмененного списка курсов"""
+        response = self.client.get('/course/')
+        etag = response['ETag']
+        response = self.client.get('/course/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = self.client.get('/course/', {'page_size': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.lesson.delete()
+        response = self.client.get('/course/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['results'][0]['lessons_count'], 0)
+
+    def test_lesson_not_modified_since(self):
+        """Тестирование ответа 304 для урока по If-Modified-Since"""
+        url = reverse('materials:lesson_view', args=(self.lesson.pk,))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        last_modified = response['Last-Modified']
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        another_user = User.objects.create(email='another@test.com')
+        self.client.force_authenticate(user=another_user)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class SparseFieldsTestCase(APITestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(email='test@test.com')
+        self.course = Course.objects.create(name='test course', description='test description', user=self.user)
+        self.lesson = Lesson.objects.create(
+            name="test lesson",
+            description="test description",
+            video_link="https://www.youtube.com/test_video_link",
+            course=self.course,
+            user=self.user
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_course_fields(self):
+        """Тестирование вывода только запрошенных полей курса"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/course/', {'fields': 'id,name,preview'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json()['results'],
+            [{'id': self.course.pk, 'name': 'test course', 'preview': None}]
+        )
+        queries = [query['sql'] for query in context.captured_queries]
+        self.assertFalse([sql for sql in queries if 'materials_lesson' in sql])
+        self.assertFalse([sql for sql in queries if '"materials_course"."description"' in sql])
+
+    def test_course_expand(self):
+        """Тестирование вывода вложенных уроков по ?expand="""
+        response = self.client.get(
+            reverse('materials:course-detail', args=(self.course.pk,)),
+            {'fields': 'id,name', 'expand': 'lessons'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(response.json()), ['id', 'lessons', 'name'])
+        self.assertEqual(response.json()['lessons'][0]['id'], self.lesson.pk)
+
+        response = self.client.get(reverse('materials:course-detail', args=(self.course.pk,)), {'expand': ''})
+        self.assertNotIn('lessons', response.json())
+        self.assertIn('description', response.json())
+
+    def test_lesson_fields(self):
+        """Тестирование вывода только запрошенных полей урока"""
+        response = self.client.get(reverse('materials:lesson_view', args=(self.lesson.pk,)), {'fields': 'id,name'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'id': self.lesson.pk, 'name': 'test lesson'})
+
+
+class LessonBulkCreateTestCase(APITestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = User.objects.create(email='test@test.com')
+        self.course = Course.objects.create(name='test course', description='test description', user=self.user)
+        self.client.force_authenticate(user=self.user)
+
+    def get_lessons(self, count, video_link='https://www.youtube.com/test_video_link'):
+        return [
+            {'name': f'lesson {i}', 'description': 'description', 'video_link': video_link} for i in range(count)
+        ]
+
+    @mock.patch('materials.services.update_course_email.apply_async')
+    def test_bulk_create_lessons(self, apply_async):
+        """Тестирование создания нескольких уроков одним запросом"""
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('materials:lesson_bulk_create'),
+                data={'course': self.course.pk, 'lessons': self.get_lessons(3)},
+                format='json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([lesson['name'] for lesson in response.json()], ['lesson 0', 'lesson 1', 'lesson 2'])
+        self.assertEqual(Lesson.objects.filter(course=self.course, user=self.user).count(), 3)
+        self.course.refresh_from_db()
+        self.assertIsNotNone(self.course.last_update)
+        apply_async.assert_called_once()
+
+    @mock.patch('materials.services.update_course_email.apply_async')
+    def test_bulk_create_bad_video_link(self, apply_async):
+        """Уроки не создаются, если хотя бы одна ссылка на видео не прошла проверку"""
+        lessons = self.get_lessons(2) + self.get_lessons(1, video_link='https://www.not-youtube.com/test_video_link')
+        response = self.client.post(
+            reverse('materials:lesson_bulk_create'),
+            data={'course': self.course.pk, 'lessons': lessons},
+            format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Lesson.objects.exists())
+        apply_async.assert_not_called()
+
+
+class CourseUpdateNotificationTestCase(APITestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = User.objects.create(email='test@test.com')
+        self.course = Course.objects.create(name='test course', description='test description', user=self.user)
+        self.lesson = Lesson.objects.create(
+            name="test lesson",
+            description="test description",
+            video_link="https://www.youtube.com/test_video_link",
+            course=self.course,
+            user=self.user
+        )
+        self.client.force_authenticate(user=self.user)
+
+    @mock.patch('materials.services.update_course_email.apply_async')
+    def test_updates_coalesced(self, apply_async):
+        """Несколько изменений курса в пределах окна дают одно отложенное уведомление"""
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(
+                reverse('materials:course-detail', args=(self.course.pk,)), data={'name': 'update test course'}
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(
+                reverse('materials:lesson_update', args=(self.lesson.pk,)),
+                data={'name': 'update test lesson', 'video_link': 'https://www.youtube.com/test_video_link'}
+            )
+        apply_async.assert_called_once_with((self.course.pk,), countdown=settings.COURSE_UPDATE_NOTIFICATION_WINDOW)
+        self.course.refresh_from_db()
+        self.assertIsNotNone(self.course.last_update)
+
+    def update_course(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(
+                reverse('materials:course-detail', args=(self.course.pk,)), data={'name': 'update test course'}
+            )
+
+    @override_settings(COURSE_UPDATE_NOTIFICATION_CACHE_DEBOUNCE=False)
+    @mock.patch('materials.services.update_course_email.apply_async')
+    def test_debounce_without_shared_cache(self, apply_async):
+        """Без общего кэша окно занимается в БД и не зависит от кэша процесса"""
+        self.update_course()
+        cache.clear()
+        self.update_course()
+        self.assertEqual(apply_async.call_count, 1)
+        CourseNotification.objects.filter(course=self.course).update(scheduled_until=timezone.now())
+        self.update_course()
+        self.assertEqual(apply_async.call_count, 2)
+
+    @override_settings(COURSE_UPDATE_NOTIFICATION_CACHE_DEBOUNCE=True)
+    @mock.patch('materials.services.update_course_email.apply_async')
+    def test_debounce_with_shared_cache(self, apply_async):
+        """С общим кэшем окно занимается ключом в кэше"""
+        self.update_course()
+        self.update_course()
+        self.assertEqual(apply_async.call_count, 1)
+        self.assertFalse(CourseNotification.objects.exists())
+
+    @mock.patch('materials.services.update_course_email.apply_async')
+    def test_notification_after_commit(self, apply_async):
+        """Уведомление не планируется до фиксации транзакции"""
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            self.client.patch(
+                reverse('materials:course-detail', args=(self.course.pk,)), data={'name': 'update test course'}
+            )
+        apply_async.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+
+
+@override_settings(COURSE_UPDATE_EMAIL_BATCH_SIZE=2)
+class UpdateCourseEmailTestCase(APITestCase):
+    def setUp(self) -> None:
+        self.course = Course.objects.create(name='test course', description='test description')
+        for i in range(5):
+            user = User.objects.create(email=f'subscriber{i}@test.com')
+            Subscription.objects.create(user=user, course=self.course)
+        inactive_user = User.objects.create(email='inactive@test.com', is_active=False)
+        Subscription.objects.create(user=inactive_user, course=self.course)
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', False)
+
+    def test_update_course_email(self):
+        """Тестирование рассылки уведомления подписчикам пачками"""
+        result = update_course_email(self.course.pk)
+        self.assertEqual(result['recipients'], 5)
+        self.assertEqual(result['batches'], 3)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            [f'subscriber{i}@test.com' for i in range(5)]
+        )
+        self.assertIn('test course', mail.outbox[0].body)
+
+
+class SubscriptionBulkTestCase(APITestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(email='test@test.com')
+        self.courses = [
+            Course.objects.create(name=f'course {i}', description='description', user=self.user) for i in range(3)
+        ]
+        self.client.force_authenticate(user=self.user)
+
+    def test_toggle_single_query(self):
+        """Переключение подписки выполняется одним запросом к БД"""
+        url = reverse('materials:subscribe_course', args=(self.courses[0].pk,))
+        with self.assertNumQueries(1):
+            response = self.client.post(url)
+        self.assertEqual(response.json(), {'message': 'подписка добавлена'})
+        self.assertEqual(Subscription.objects.filter(user=self.user).count(), 1)
+
+        response = self.client.post(reverse('materials:subscribe_course', args=(self.courses[-1].pk + 1,)))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_bulk_subscribe(self):
+        """Тестирование подписки и отписки от нескольких курсов одним запросом"""
+        Subscription.objects.create(user=self.user, course=self.courses[0])
+        response = self.client.post(
+            reverse('materials:subscriptions_bulk'),
+            data={'subscribe': [course.pk for course in self.courses[1:]] + [self.courses[-1].pk + 1],
+                  'unsubscribe': [self.courses[0].pk]},
+            format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {
+            'subscribed': [course.pk for course in self.courses[1:]],
+            'unsubscribed': 1
+        })
+
+        response = self.client.post(
+            reverse('materials:subscriptions_bulk'),
+            data={'subscribe': [self.courses[1].pk]},
+            format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(reverse('materials:subscriptions'))
+        self.assertEqual(
+            [subscription['course'] for subscription in response.json()['results']],
+            [course.pk for course in self.courses[1:]]
+        )
+
+
+class MaterialsSearchTestCase(APITestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = User.objects.create(email='test@test.com')
+        self.other = User.objects.create(email='other@test.com')
+        self.course = Course.objects.create(
+            name='Программирование на Python', description='Основы языка и веб-фреймворки', user=self.user
+        )
+        self.lesson = Lesson.objects.create(
+            name='Установка Django',
+            description='Разбираем программирование веб-приложений',
+            video_link='https://www.youtube.com/test_video_link',
+            course=self.course,
+            user=self.user
+        )
+        self.other_course = Course.objects.create(
+            name='Программирование на Go', description='Чужой курс', user=self.other
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def search(self, **params):
+        response = self.client.get(reverse('materials:search'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(result['type'], result['id']) for result in response.json()['results']]
+
+    def test_search_prefix_and_rank(self):
+        """Поиск по началу слова с учетом морфологии, совпадение в названии выше совпадения в описании"""
+        self.assertEqual(self.search(q='программ'), [('course', self.course.pk), ('lesson', self.lesson.pk)])
+        self.assertEqual(self.search(q='программированию python'), [('course', self.course.pk)])
+        self.assertEqual(self.search(q='djan'), [('lesson', self.lesson.pk)])
+        self.assertEqual(self.search(q='программ', type='lesson'), [('lesson', self.lesson.pk)])
+        response = self.client.get(reverse('materials:search'), {'q': 'djan'})
+        self.assertEqual(response.json()['results'][0]['course'], self.course.pk)
+
+    def test_search_scope(self):
+        """Пользователь находит только свои курсы и уроки, модератор - все"""
+        self.assertNotIn(('course', self.other_course.pk), self.search(q='программирование'))
+        self.user.groups.add(Group.objects.create(name='moderator'))
+        self.assertIn(('course', self.other_course.pk), self.search(q='программирование'))
+
+    @mock.patch('materials.services.update_course_email.apply_async')
+    def test_search_vector_updated(self, apply_async):
+        """Поисковый вектор пересчитывается при изменении, в том числе для уроков из bulk_create"""
+        self.course.name = 'Машинное обучение'
+        self.course.save()
+        self.assertEqual(self.search(q='машин'), [('course', self.course.pk)])
+        lessons = [{'name': 'Нейронные сети', 'description': 'описание', 'video_link': 'https://www.youtube.com/test'}]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('materials:lesson_bulk_create'),
+                data={'course': self.course.pk, 'lessons': lessons},
+                format='json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.search(q='нейрон'), [('lesson', response.json()[0]['id'])])
+
+    def test_search_bad_params(self):
+        """Без строки поиска или с неизвестным типом возвращается ошибка"""
+        self.assertEqual(self.client.get(reverse('materials:search'), {'q': ' !'}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(reverse('materials:search'), {'q': 'курс', 'type': 'user'}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
@@ -3,8 +3,9 @@ from rest_framework.routers import DefaultRouter
 
 from materials.apps import MaterialsConfig
 from materials.views import CourseViewSet, LessonListAPIView, LessonCreateAPIView, LessonRetrieveAPIView, \
-    LessonUpdateAPIView, LessonDestroyAPIView, SubscriptionAPIView
-from users.views import PaymentViewSet, PaymentStatusAPIView
+    LessonUpdateAPIView, LessonDestroyAPIView, SubscriptionAPIView, LessonBulkCreateAPIView, SubscriptionListAPIView, \
+    SubscriptionBulkAPIView, MaterialsSearchAPIView
+from users.views import PaymentViewSet, PaymentStatusAPIView, PaymentWebhookAPIView, PaymentCircuitAPIView
 
 app_name = MaterialsConfig.name
 
@@ -13,11 +14,17 @@ router.register(r'course', CourseViewSet, basename='course')
 router.register(r'payment', PaymentViewSet, basename='payment')
 
 urlpatterns = [
+    path('search/', MaterialsSearchAPIView.as_view(), name='search'),
     path('course/<int:pk>/subscribe/', SubscriptionAPIView.as_view(), name='subscribe_course'),
+    path('subscription/', SubscriptionListAPIView.as_view(), name='subscriptions'),
+    path('subscription/bulk/', SubscriptionBulkAPIView.as_view(), name='subscriptions_bulk'),
     path('lesson/', LessonListAPIView.as_view(), name='lesson_view'),
     path('lesson/create/', LessonCreateAPIView.as_view(), name='lesson_create'),
+    path('lesson/bulk_create/', LessonBulkCreateAPIView.as_view(), name='lesson_bulk_create'),
     path('lesson/<int:pk>/', LessonRetrieveAPIView.as_view(), name='lesson_view'),
     path('lesson/update/<int:pk>/', LessonUpdateAPIView.as_view(), name='lesson_update'),
     path('lesson/delete/<int:pk>/', LessonDestroyAPIView.as_view(), name='lesson_delete'),
     path('payment/<int:pk>/status/', PaymentStatusAPIView.as_view(), name='payment_status'),
+    path('payment/webhook/', PaymentWebhookAPIView.as_view(), name='payment_webhook'),
+    path('payment/circuit/', PaymentCircuitAPIView.as_view(), name='payment_circuit'),
 ] + router.urls
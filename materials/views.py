@@ -1,26 +1,32 @@
-import datetime
-
 from django.conf import settings
-from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.db.models import Count, Exists, Max, OuterRef, Prefetch
+from django.http import Http404
 from django.utils import timezone
-from rest_framework import viewsets, generics
+from rest_framework import viewsets, generics, status
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from materials.mixins import ConditionalGetMixin, SparseFieldsMixin
 from materials.models import Course, Lesson, Subscription
-from materials.paginators import MaterialsPaginator
-from materials.serializes import CourseSerializer, LessonSerializer
-from materials.tasks import update_course_email
+from materials.paginators import MaterialsPaginator, SearchPaginator
+from materials.search import build_search_query, search_materials, update_search_vector
+from materials.serializes import CourseSerializer, LessonSerializer, LessonBulkCreateSerializer, \
+    SubscriptionSerializer, SubscriptionBulkSerializer, SearchResultSerializer
+from materials.services import schedule_course_update_notification
 from users.permissions import IsModerator, IsOwner
+from users.roles import is_moderator
 
 
 # Create your views here.
 
-class CourseViewSet(viewsets.ModelViewSet):
+class CourseViewSet(ConditionalGetMixin, SparseFieldsMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     pagination_class = MaterialsPaginator
     serializer_class = CourseSerializer
+    sparse_excluded_fields = ('search_vector',)
 
     def get_permissions(self):
         if self.action in ['retrieve', 'update']:
@@ -34,22 +40,67 @@ class CourseViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    def get_scoped_queryset(self):
+        """Возвращает курсы, доступные текущему пользователю"""
+        if is_moderator(self.request):
+            return Course.objects.all()
+        return Course.objects.filter(user=self.request.user)
+
     def get_queryset(self):
-        if self.request.user.groups.filter(name='moderator').exists():
-            queryset = Course.objects.all()
-        else:
-            queryset = Course.objects.filter(user=self.request.user)
+        response_fields = self.get_response_fields()
+        queryset = self.only_response_fields(self.get_scoped_queryset(), response_fields)
+        if 'lessons_count' in response_fields:
+            queryset = queryset.annotate(lessons_count=Count('lesson'))
+        if 'is_subscribed' in response_fields:
+            queryset = queryset.annotate(
+                is_subscribed=Exists(Subscription.objects.filter(user=self.request.user, course=OuterRef('pk')))
+            )
+        if 'lessons' in response_fields:
+            queryset = queryset.prefetch_related(
+                Prefetch('lesson_set', queryset=Lesson.objects.defer(*self.sparse_excluded_fields))
+            )
         return queryset
 
+    def get_conditional_queryset(self):
+        return self.filter_queryset(self.get_scoped_queryset())
+
+    def get_object_state_annotations(self):
+        response_fields = self.get_response_fields()
+        annotations = {}
+        if 'lessons' in response_fields or 'lessons_count' in response_fields:
+            annotations.update(
+                lessons_count=Count('lesson'),
+                lessons_max_pk=Max('lesson__id'),
+                lessons_last_update=Max('lesson__last_update'),
+            )
+        if 'is_subscribed' in response_fields:
+            annotations['is_subscribed'] = Exists(
+                Subscription.objects.filter(user=self.request.user, course=OuterRef('pk'))
+            )
+        return annotations
+
+    def get_list_state_aggregates(self):
+        response_fields = self.get_response_fields()
+        if 'lessons' not in response_fields and 'lessons_count' not in response_fields:
+            return {}
+        return {
+            'lessons_count': Count('lesson', distinct=True),
+            'lessons_max_pk': Max('lesson__id'),
+            'lessons_last_update': Max('lesson__last_update'),
+        }
+
+    def get_list_state(self):
+        state = super().get_list_state()
+        if 'is_subscribed' in self.get_response_fields():
+            state.update(Subscription.objects.filter(
+                user=self.request.user,
+                course__in=self.get_conditional_queryset()
+            ).aggregate(subscriptions_count=Count('pk'), subscriptions_max_pk=Max('pk')))
+        return state
+
     def perform_update(self, serializer):
-        course = serializer.save()
-        if course.last_update:
-            if timezone.now() - course.last_update > datetime.timedelta(hours=4):
-                update_course_email.delay(course)
-        else:
-            update_course_email.delay(course)
-        course.last_update = timezone.now()
-        course.save()
+        course = serializer.save(last_update=timezone.now())
+        schedule_course_update_notification(course.pk)
 
 
 class LessonCreateAPIView(generics.CreateAPIView):
@@ -57,36 +108,64 @@ class LessonCreateAPIView(generics.CreateAPIView):
     permission_classes = [IsAuthenticated, ~IsModerator]
 
     def perform_create(self, serializer):
-        lesson = serializer.save()
-        lesson.user = self.request.user
-        if lesson.course.last_update:
-            if timezone.now() - lesson.course.last_update > datetime.timedelta(hours=4):
-                update_course_email.delay(lesson.course)
-        else:
-            update_course_email.delay(lesson.course)
-        lesson.course.last_update = timezone.now()
-        lesson.course.save()
-        lesson.last_update = timezone.now()
-        lesson.save()
+        now = timezone.now()
+        lesson = serializer.save(user=self.request.user, last_update=now)
+        Course.objects.filter(pk=lesson.course_id).update(last_update=now)
+        schedule_course_update_notification(lesson.course_id)
 
 
-class LessonListAPIView(generics.ListAPIView):
+class LessonBulkCreateAPIView(generics.CreateAPIView):
+    """Создает несколько уроков одного курса за один запрос"""
+    serializer_class = LessonBulkCreateSerializer
+    permission_classes = [IsAuthenticated, ~IsModerator]
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        lessons = self.perform_create(serializer)
+        return Response(
+            LessonSerializer(lessons, many=True, context=self.get_serializer_context()).data,
+            status=status.HTTP_201_CREATED
+        )
+
+    def perform_create(self, serializer):
+        course = serializer.validated_data['course']
+        now = timezone.now()
+        with transaction.atomic():
+            lessons = Lesson.objects.bulk_create([
+                Lesson(course=course, user=self.request.user, last_update=now, **lesson)
+                for lesson in serializer.validated_data['lessons']
+            ])
+            # bulk_create не вызывает сигналы, поэтому поисковый вектор считаем одним UPDATE
+            update_search_vector(Lesson.objects.filter(pk__in=[lesson.pk for lesson in lessons]))
+            Course.objects.filter(pk=course.pk).update(last_update=now)
+            schedule_course_update_notification(course.pk)
+        return lessons
+
+
+class LessonListAPIView(ConditionalGetMixin, SparseFieldsMixin, generics.ListAPIView):
     serializer_class = LessonSerializer
     permission_classes = [IsAuthenticated, IsModerator | IsOwner]
     pagination_class = MaterialsPaginator
+    sparse_excluded_fields = ('search_vector',)
 
     def get_queryset(self):
-        if self.request.user.groups.filter(name='moderator').exists():
+        if is_moderator(self.request):
             queryset = Lesson.objects.all()
         else:
             queryset = Lesson.objects.filter(user=self.request.user)
-        return queryset
+        return self.only_response_fields(queryset, self.get_response_fields())
 
 
-class LessonRetrieveAPIView(generics.RetrieveAPIView):
+class LessonRetrieveAPIView(ConditionalGetMixin, SparseFieldsMixin, generics.RetrieveAPIView):
     serializer_class = LessonSerializer
     queryset = Lesson.objects.all()
     permission_classes = [IsAuthenticated, IsModerator | IsOwner]
+    honor_if_modified_since = True
+    sparse_excluded_fields = ('search_vector',)
+
+    def get_queryset(self):
+        return self.only_response_fields(super().get_queryset(), self.get_response_fields())
 
 
 class LessonUpdateAPIView(generics.UpdateAPIView):
@@ -95,16 +174,10 @@ class LessonUpdateAPIView(generics.UpdateAPIView):
     permission_classes = [IsAuthenticated, IsModerator | IsOwner]
 
     def perform_update(self, serializer):
-        lesson = serializer.save()
-        if lesson.course.last_update:
-            if timezone.now() - lesson.course.last_update > datetime.timedelta(hours=4):
-                update_course_email.delay(lesson.course)
-        else:
-            update_course_email.delay(lesson.course)
-        lesson.course.last_update = timezone.now()
-        lesson.course.save()
-        lesson.last_update = timezone.now()
-        lesson.save()
+        now = timezone.now()
+        lesson = serializer.save(last_update=now)
+        Course.objects.filter(pk=lesson.course_id).update(last_update=now)
+        schedule_course_update_notification(lesson.course_id)
 
 
 class LessonDestroyAPIView(generics.DestroyAPIView):
@@ -113,19 +186,78 @@ class LessonDestroyAPIView(generics.DestroyAPIView):
     permission_classes = [IsAuthenticated, IsOwner]
 
 
+class MaterialsSearchAPIView(generics.ListAPIView):
+    """Полнотекстовый поиск по курсам и урокам с поиском по началу слов и сортировкой по релевантности"""
+    serializer_class = SearchResultSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = SearchPaginator
+    search_types = ('course', 'lesson')
+
+    def get_queryset(self):
+        query = build_search_query(self.request.query_params.get('q', ''))
+        if query is None:
+            raise ValidationError({'q': 'Укажите строку поиска'})
+        search_type = self.request.query_params.get('type')
+        if search_type is not None and search_type not in self.search_types:
+            raise ValidationError({'type': f'Допустимые значения: {", ".join(self.search_types)}'})
+        courses = Course.objects.all()
+        lessons = Lesson.objects.all()
+        if not is_moderator(self.request):
+            courses = courses.filter(user=self.request.user)
+            lessons = lessons.filter(user=self.request.user)
+        return search_materials(
+            query,
+            courses=courses if search_type in (None, 'course') else None,
+            lessons=lessons if search_type in (None, 'lesson') else None,
+        )
+
+
 class SubscriptionAPIView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, *args, **kwargs):
         user = self.request.user
         course_id = self.request.parser_context['kwargs']['pk']
-        course_item = get_object_or_404(Course, pk=course_id)
-        subs_item = Subscription.objects.filter(user=user, course=course_item)
+        subscribed = Subscription.objects.toggle(user.pk, course_id)
 
-        if subs_item.exists():
-            subs_item.delete()
-            message = 'подписка удалена'
-        else:
-            Subscription.objects.create(user=user, course=course_item)
+        if subscribed is None:
+            raise Http404
+        elif subscribed:
             message = 'подписка добавлена'
+        else:
+            message = 'подписка удалена'
         return Response({"message": message})
+
+
+class SubscriptionListAPIView(generics.ListAPIView):
+    """Выводит подписки текущего пользователя"""
+    serializer_class = SubscriptionSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = MaterialsPaginator
+
+    def get_queryset(self):
+        return Subscription.objects.filter(user=self.request.user).order_by('course')
+
+
+class SubscriptionBulkAPIView(APIView):
+    """Подписывает на несколько курсов и отписывает от нескольких курсов одним запросом"""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, *args, **kwargs):
+        serializer = SubscriptionBulkSerializer(data=self.request.data)
+        serializer.is_valid(raise_exception=True)
+        user = self.request.user
+        subscribe = serializer.validated_data.get('subscribe', [])
+        unsubscribe = serializer.validated_data.get('unsubscribe', [])
+
+        with transaction.atomic():
+            course_ids = list(Course.objects.filter(pk__in=subscribe).values_list('pk', flat=True))
+            Subscription.objects.bulk_create(
+                [Subscription(user=user, course_id=course_id) for course_id in course_ids],
+                ignore_conflicts=True
+            )
+            unsubscribed, _ = Subscription.objects.filter(user=user, course__in=unsubscribe).delete()
+        return Response({
+            'subscribed': sorted(course_ids),
+            'unsubscribed': unsubscribed
+        })
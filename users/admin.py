@@ -1,8 +1,7 @@
 from django.contrib import admin
 
-from users.models import User
+from users.models import User, StripePrice
 
 # Register your models here.
 admin.site.register(User)
-
-
+admin.site.register(StripePrice)
@@ -0,0 +1,122 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+USER_AUTH_GENERATION_KEY = 'user_auth_generation'
+USER_AUTH_LOCAL_CACHE_SIZE = 1024
+
+_local_users = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def get_user_auth_version_key(user_id):
+    """Возвращает ключ кэша версии пользователя, версия меняется при каждом изменении пользователя"""
+    return f'user_auth_version:{user_id}'
+
+
+def get_user_auth_key(user_id, generation, version):
+    return f'user_auth:{user_id}:{generation}:{version}'
+
+
+def invalidate_user_auth(user_ids):
+    """Сбрасывает кэш пользователей для аутентификации"""
+    for user_id in user_ids:
+        key = get_user_auth_version_key(user_id)
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+        with _local_lock:
+            _local_users.pop(user_id, None)
+
+
+def invalidate_all_user_auth():
+    """Сбрасывает кэш всех пользователей, например после массовой деактивации UPDATE без сигналов"""
+    cache.add(USER_AUTH_GENERATION_KEY, 0, None)
+    try:
+        cache.incr(USER_AUTH_GENERATION_KEY)
+    except ValueError:
+        cache.set(USER_AUTH_GENERATION_KEY, 1, None)
+    clear_local_user_auth()
+
+
+def clear_local_user_auth():
+    with _local_lock:
+        _local_users.clear()
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    Аутентификация по JWT, которая берет пользователя из кэша вместо запроса к БД.
+    Перед кэшем Django (Redis) стоит короткоживущий LRU кэш процесса.
+    При USER_AUTH_CACHE_TIMEOUT = 0 (нет общего кэша) пользователь загружается из БД при каждом запросе
+    """
+
+    def get_user(self, validated_token):
+        if not settings.USER_AUTH_CACHE_TIMEOUT:
+            return super().get_user(validated_token)
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        user = self.get_local_user(user_id)
+        if user is None:
+            user = self.get_cached_user(user_id, validated_token)
+            self.set_local_user(user_id, user)
+        self.check_user(user, validated_token)
+        # Копия, чтобы изменения пользователя в одном запросе не попали в кэш процесса
+        return copy.copy(user)
+
+    def get_cached_user(self, user_id, validated_token):
+        version_key = get_user_auth_version_key(user_id)
+        versions = cache.get_many([USER_AUTH_GENERATION_KEY, version_key])
+        key = get_user_auth_key(user_id, versions.get(USER_AUTH_GENERATION_KEY, 0), versions.get(version_key, 0))
+        user = cache.get(key)
+        if user is None:
+            try:
+                user = self.user_model.objects.get(**{api_settings.USER_ID_FIELD: user_id})
+            except self.user_model.DoesNotExist:
+                raise AuthenticationFailed(_('User not found'), code='user_not_found')
+            cache.set(key, user, settings.USER_AUTH_CACHE_TIMEOUT)
+        return user
+
+    def get_local_user(self, user_id):
+        with _local_lock:
+            entry = _local_users.get(user_id)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at < time.monotonic():
+                del _local_users[user_id]
+                return None
+            _local_users.move_to_end(user_id)
+            return user
+
+    def set_local_user(self, user_id, user):
+        timeout = settings.USER_AUTH_LOCAL_CACHE_TIMEOUT
+        if not timeout:
+            return
+        with _local_lock:
+            _local_users[user_id] = (time.monotonic() + timeout, user)
+            _local_users.move_to_end(user_id)
+            while len(_local_users) > USER_AUTH_LOCAL_CACHE_SIZE:
+                _local_users.popitem(last=False)
+
+    def check_user(self, user, validated_token):
+        """Те же проверки, что у JWTAuthentication.get_user, но для пользователя из кэша"""
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code='password_changed')
@@ -0,0 +1,76 @@
+import csv
+import json
+
+from django.db import models
+
+from users.serializes import PaymentSerializer
+
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class LineBuffer:
+    """Буфер для csv.writer, который возвращает записанную строку вместо записи в файл"""
+
+    def write(self, value):
+        return value
+
+
+def get_export_columns():
+    """Поля PaymentSerializer с именами столбцов в БД и полем сериализатора для форматирования значений"""
+    serializer_fields = PaymentSerializer().fields
+    columns = []
+    for name, model_field in ((field.name, field) for field in PaymentSerializer.Meta.model._meta.concrete_fields):
+        if name in serializer_fields:
+            representation = None if isinstance(model_field, models.ForeignKey) else serializer_fields[name]
+            columns.append((name, model_field.attname, representation))
+    return columns
+
+
+def iter_payment_rows(queryset, chunk_size):
+    """Перебирает платежи серверным курсором, память не зависит от размера выгрузки"""
+    columns = get_export_columns()
+    rows = queryset.values_list(*(attname for name, attname, representation in columns)).iterator(chunk_size=chunk_size)
+    for row in rows:
+        yield {
+            name: value if value is None or representation is None else representation.to_representation(value)
+            for (name, attname, representation), value in zip(columns, row)
+        }
+
+
+def iter_chunks(lines, chunk_size):
+    """Склеивает строки в крупные куски, чтобы не отдавать клиенту по строке за раз"""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def iter_csv(queryset, chunk_size):
+    writer = csv.writer(LineBuffer())
+    columns = [name for name, attname, representation in get_export_columns()]
+    yield writer.writerow(columns)
+    rows = (writer.writerow([row[name] for name in columns]) for row in iter_payment_rows(queryset, chunk_size))
+    yield from iter_chunks(rows, chunk_size)
+
+
+def iter_ndjson(queryset, chunk_size):
+    rows = (json.dumps(row, ensure_ascii=False) + '\n' for row in iter_payment_rows(queryset, chunk_size))
+    yield from iter_chunks(rows, chunk_size)
+
+
+EXPORTERS = {
+    'csv': iter_csv,
+    'ndjson': iter_ndjson,
+}
+
+
+def export_payments(queryset, export_format, chunk_size):
+    """Возвращает генератор строк выгрузки платежей в формате csv или ndjson"""
+    return EXPORTERS[export_format](queryset, chunk_size)
@@ -0,0 +1,154 @@
+import hashlib
+import hmac
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import stripe
+
+
+def sign_webhook_payload(payload, secret, timestamp=None):
+    """Возвращает заголовок Stripe-Signature для тела вебхука, как его подписывает stripe"""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def make_webhook_event(event_type, session, created=None):
+    """Собирает тело события stripe для сессии оплаты"""
+    return json.dumps({
+        'id': f'evt_{session["id"]}',
+        'object': 'event',
+        'type': event_type,
+        'created': int(time.time()) if created is None else created,
+        'data': {'object': session},
+    })
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    """Обработчик запросов, имитирующий API stripe"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        # Новое соединение обходится дороже повторного использования, как TLS рукопожатие с api.stripe.com
+        self.server.connections += 1
+        time.sleep(self.server.connect_delay)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        self.server.requests.append(('POST', self.path, params))
+        # Как и stripe, на повтор запроса с тем же Idempotency-Key отдаем сохраненный ответ
+        idempotency_key = self.headers.get('Idempotency-Key')
+        if idempotency_key in self.server.idempotent_responses:
+            return self.send_json(200, self.server.idempotent_responses[idempotency_key])
+        obj_id = next(self.server.ids)
+        if self.path == '/v1/products':
+            return self.send_json(200, {'id': f'prod_{obj_id}', 'object': 'product', 'name': params.get('name')})
+        if self.path == '/v1/prices':
+            return self.send_json(200, {
+                'id': f'price_{obj_id}', 'object': 'price', 'product': params.get('product'),
+                'unit_amount': int(params.get('unit_amount', 0)), 'currency': params.get('currency'),
+            })
+        if self.path == '/v1/checkout/sessions':
+            session = {
+                'id': f'cs_test_{obj_id}', 'object': 'checkout.session',
+                'url': f'https://checkout.stripe.com/c/pay/cs_test_{obj_id}',
+                'payment_method_types': ['card'], 'payment_status': 'unpaid', 'status': 'open',
+                'created': int(time.time()),
+            }
+            self.server.sessions[session['id']] = session
+            if idempotency_key:
+                self.server.idempotent_responses[idempotency_key] = session
+            return self.send_json(200, session)
+        self.send_json(404, {'error': {'type': 'invalid_request_error', 'message': 'Unrecognized request URL'}})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.server.requests.append(('GET', url.path, params))
+        if url.path == '/v1/checkout/sessions':
+            return self.send_json(200, self.list_sessions(params))
+        prefix = '/v1/checkout/sessions/'
+        session = self.server.sessions.get(url.path[len(prefix):]) if url.path.startswith(prefix) else None
+        if session is None:
+            return self.send_json(404, {'error': {'type': 'invalid_request_error', 'message': 'No such session'}})
+        self.send_json(200, session)
+
+    def list_sessions(self, params):
+        """Страница списка сессий: от новых к старым, с фильтром created[gte] и курсором starting_after"""
+        sessions = [session for session in reversed(list(self.server.sessions.values()))
+                    if session['created'] >= int(params.get('created[gte]', 0))]
+        if 'starting_after' in params:
+            ids = [session['id'] for session in sessions]
+            sessions = sessions[ids.index(params['starting_after']) + 1:]
+        limit = int(params.get('limit', 10))
+        return {'object': 'list', 'url': '/v1/checkout/sessions', 'data': sessions[:limit],
+                'has_more': len(sessions) > limit}
+
+
+class FakeStripeServer:
+    """Локальный HTTP сервер stripe для тестов и замеров, на время работы подменяет stripe.api_base"""
+
+    def __init__(self, connect_delay=0):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakeStripeHandler)
+        self.httpd.connections = 0
+        self.httpd.connect_delay = connect_delay
+        self.httpd.requests = []
+        self.httpd.sessions = {}
+        self.httpd.idempotent_responses = {}
+        self.httpd.ids = itertools.count(1)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.httpd.server_port}'
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    @property
+    def connections(self):
+        return self.httpd.connections
+
+    @property
+    def idempotency_keys(self):
+        return list(self.httpd.idempotent_responses)
+
+    @property
+    def sessions(self):
+        return self.httpd.sessions
+
+    def complete_session(self, session_id):
+        """Переводит сессию в оплаченную и возвращает ее"""
+        session = self.sessions[session_id]
+        session.update(payment_status='paid', status='complete')
+        return session
+
+    def __enter__(self):
+        self.thread.start()
+        self.saved = stripe.api_base, stripe.api_key
+        stripe.api_base, stripe.api_key = self.url, 'sk_test_fake'
+        return self
+
+    def __exit__(self, *exc_info):
+        stripe.api_base, stripe.api_key = self.saved
+        self.httpd.shutdown()
+        self.httpd.server_close()
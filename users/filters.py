@@ -0,0 +1,13 @@
+from django_filters import rest_framework as filters
+
+from users.models import Payment
+
+
+class PaymentFilter(filters.FilterSet):
+    """Фильтры платежей: курс, урок, способ оплаты и диапазон дат"""
+    date_after = filters.IsoDateTimeFilter(field_name='date', lookup_expr='gte')
+    date_before = filters.IsoDateTimeFilter(field_name='date', lookup_expr='lt')
+
+    class Meta:
+        model = Payment
+        fields = ('course', 'lesson', 'payment_method')
@@ -0,0 +1,97 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+
+from users.models import User
+
+LAST_LOGIN_SEQUENCE_KEY = 'last_login:sequence'
+LAST_LOGIN_CURSOR_KEY = 'last_login:cursor'
+LAST_LOGIN_MISSING_KEY = 'last_login:missing'
+LAST_LOGIN_LOCK_KEY = 'last_login:lock'
+LAST_LOGIN_LOCK_TIMEOUT = 5 * 60
+LAST_LOGIN_LOCK_POLL_INTERVAL = 0.1
+
+
+def get_last_login_key(index):
+    """Возвращает ключ кэша записи о входе с порядковым номером index"""
+    return f'last_login:entry:{index}'
+
+
+def record_last_login(user_id, when=None):
+    """Запоминает время входа пользователя в кэше, в БД оно попадет при следующем сбросе буфера"""
+    cache.add(LAST_LOGIN_SEQUENCE_KEY, 0, None)
+    try:
+        index = cache.incr(LAST_LOGIN_SEQUENCE_KEY)
+    except ValueError:
+        # Счетчик вытеснили из кэша между add и incr
+        cache.add(LAST_LOGIN_SEQUENCE_KEY, 0, None)
+        index = cache.incr(LAST_LOGIN_SEQUENCE_KEY)
+    cache.set(get_last_login_key(index), (user_id, when or timezone.now()), settings.LAST_LOGIN_BUFFER_TIMEOUT)
+
+
+def save_last_logins(last_logins, batch_size):
+    """Сохраняет время входа одним UPDATE ... FROM VALUES на пачку, не сдвигая last_login назад"""
+    table = connection.ops.quote_name(User._meta.db_table)
+    items = list(last_logins.items())
+    updated = 0
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        values = ', '.join(['(%s::bigint, %s::timestamptz)'] * len(batch))
+        params = [value for item in batch for value in item]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} AS u SET last_login = v.last_login '
+                f'FROM (VALUES {values}) AS v(id, last_login) '
+                f'WHERE u.id = v.id AND (u.last_login IS NULL OR u.last_login < v.last_login)',
+                params
+            )
+            updated += cursor.rowcount
+    return updated
+
+
+def flush_last_login_buffer(batch_size=None, wait=0):
+    """
+    Переносит накопленные в кэше входы пользователей в БД.
+    Если сброс уже идет в другом процессе, ждет его окончания до wait секунд и возвращает None, если не дождался
+    """
+    deadline = time.monotonic() + wait
+    while not cache.add(LAST_LOGIN_LOCK_KEY, 1, LAST_LOGIN_LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(LAST_LOGIN_LOCK_POLL_INTERVAL)
+    try:
+        batch_size = batch_size or settings.LAST_LOGIN_FLUSH_BATCH_SIZE
+        state = cache.get_many([LAST_LOGIN_SEQUENCE_KEY, LAST_LOGIN_CURSOR_KEY, LAST_LOGIN_MISSING_KEY])
+        sequence = state.get(LAST_LOGIN_SEQUENCE_KEY, 0)
+        cursor = state.get(LAST_LOGIN_CURSOR_KEY, 0)
+        if cursor > sequence:
+            # Счетчик вытеснили из кэша и нумерация началась заново
+            cursor = 0
+        # Номер мог быть выдан, а запись еще не сохранена: такие номера проверяем еще раз при следующем сбросе
+        indexes = state.get(LAST_LOGIN_MISSING_KEY, []) + list(range(cursor + 1, sequence + 1))
+        last_logins = {}
+        found = []
+        missing = []
+        for start in range(0, len(indexes), batch_size):
+            keys = [get_last_login_key(index) for index in indexes[start:start + batch_size]]
+            entries = cache.get_many(keys)
+            for index, key in zip(indexes[start:start + batch_size], keys):
+                entry = entries.get(key)
+                if entry is None:
+                    if index > cursor:
+                        missing.append(index)
+                    continue
+                user_id, when = entry
+                found.append(key)
+                if user_id not in last_logins or last_logins[user_id] < when:
+                    last_logins[user_id] = when
+        updated = save_last_logins(last_logins, batch_size)
+        cache.set_many({LAST_LOGIN_CURSOR_KEY: sequence, LAST_LOGIN_MISSING_KEY: missing}, None)
+        for start in range(0, len(found), batch_size):
+            cache.delete_many(found[start:start + batch_size])
+    finally:
+        cache.delete(LAST_LOGIN_LOCK_KEY)
+    return {'entries': len(found), 'users': len(last_logins), 'updated': updated, 'missing': len(missing)}
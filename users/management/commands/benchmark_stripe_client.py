@@ -0,0 +1,51 @@
+import stripe
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from users.fake_stripe import FakeStripeServer
+from users.stripe_client import PooledRequestsClient
+
+
+class NewConnectionClient(PooledRequestsClient):
+    """Клиент без переиспользования соединений - каждый запрос открывает новое"""
+
+    def request(self, method, url, headers, post_data=None):
+        try:
+            return super().request(method, url, headers, post_data)
+        finally:
+            self.close()
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает задержку запросов в stripe с пулом keep-alive соединений и без него на локальном сервере'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Количество запросов каждым клиентом')
+        parser.add_argument('--connect-delay', type=float, default=0.02,
+                            help='Задержка установки соединения на сервере в секундах (имитация TLS)')
+
+    def handle(self, *args, **options):
+        client_options = {
+            'connect_timeout': settings.STRIPE_CONNECT_TIMEOUT,
+            'read_timeout': settings.STRIPE_READ_TIMEOUT,
+            'pool_size': settings.STRIPE_POOL_SIZE,
+        }
+        saved_client = stripe.default_http_client
+        try:
+            with FakeStripeServer(connect_delay=options['connect_delay']) as server:
+                session_id = stripe.checkout.Session.create(line_items=[], mode='payment').get('id')
+                for name, client in (('без пула', NewConnectionClient(**client_options)),
+                                     ('с пулом', PooledRequestsClient(**client_options))):
+                    stripe.default_http_client = client
+                    connections = server.connections
+                    for _ in range(options['requests']):
+                        stripe.checkout.Session.retrieve(session_id)
+                    stats = client.stats
+                    self.stdout.write(
+                        f'{name}: {stats["requests"]} запросов, {server.connections - connections} соединений, '
+                        f'в среднем {stats["seconds"] / stats["requests"] * 1000:.2f} мс, '
+                        f'максимум {stats["max_seconds"] * 1000:.2f} мс'
+                    )
+                    client.close()
+        finally:
+            stripe.default_http_client = saved_client
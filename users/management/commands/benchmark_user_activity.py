@@ -0,0 +1,46 @@
+import time
+
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+
+from materials.tasks import check_user_activity, get_inactive_users
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = 'Замеряет check_user_activity на синтетической таблице пользователей (изменения откатываются)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000, help='Количество синтетических пользователей')
+        parser.add_argument('--batch-size', type=int, default=None, help='Размер пачки UPDATE')
+
+    def handle(self, *args, **options):
+        table = connection.ops.quote_name(User._meta.db_table)
+        with transaction.atomic():
+            started = time.monotonic()
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    INSERT INTO {table} (password, last_login, is_superuser, first_name, last_name,
+                                         is_staff, is_active, date_joined, email)
+                    SELECT '',
+                           CASE WHEN i %% 3 = 0 THEN NULL ELSE now() - (i %% 90) * interval '1 day' END,
+                           false, '', '', false, true,
+                           now() - (i %% 120) * interval '1 day',
+                           'benchmark-user-' || i || '@example.com'
+                    FROM generate_series(1, %s) AS i
+                    """,
+                    [options['users']]
+                )
+                cursor.execute(f'ANALYZE {table}')
+            self.stdout.write(f'Создано {options["users"]} пользователей за {time.monotonic() - started:.2f} с')
+
+            self.stdout.write(get_inactive_users().values('pk').explain())
+            dry_run = check_user_activity(dry_run=True)
+            self.stdout.write(f'Пробный запуск: найдено {dry_run["found"]} за {dry_run["seconds"]:.2f} с')
+            result = check_user_activity(batch_size=options['batch_size'])
+            self.stdout.write(
+                f'Деактивировано {result["deactivated"]} пользователей '
+                f'за {result["batches"]} UPDATE и {result["seconds"]:.2f} с'
+            )
+            transaction.set_rollback(True)
@@ -0,0 +1,76 @@
+import hashlib
+import statistics
+import time
+
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from users.models import User
+from users.views import UserListAPIView
+
+CITIES = ['Москва', 'Екатеринбург', 'Новосибирск', 'Казань', 'Самара', 'Пермь', 'Тюмень', 'Омск']
+
+
+class Command(BaseCommand):
+    help = 'Замеряет время ответа списка пользователей с поиском на синтетической таблице (изменения откатываются)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000, help='Количество синтетических пользователей')
+        parser.add_argument('--repeat', type=int, default=20, help='Количество запросов на каждый вариант')
+        parser.add_argument('--budget-ms', type=float, default=50, help='Допустимая медиана времени ответа в мс')
+
+    def handle(self, *args, **options):
+        table = connection.ops.quote_name(User._meta.db_table)
+        with transaction.atomic():
+            started = time.monotonic()
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    INSERT INTO {table} (password, is_superuser, first_name, last_name, is_staff, is_active,
+                                         date_joined, email, city, phone)
+                    SELECT '', false, '', '', false, true, now(),
+                           substr(md5(i::text), 1, 12) || '@' || (ARRAY['mail.ru', 'yandex.ru', 'gmail.com'])[i %% 3 + 1],
+                           (%(cities)s::text[])[i %% %(city_count)s + 1],
+                           '+7900' || lpad(i::text, 7, '0')
+                    FROM generate_series(1, %(users)s) AS i
+                    """,
+                    {'users': options['users'], 'cities': CITIES, 'city_count': len(CITIES)}
+                )
+                # Строки попали в список ожидания GIN индексов, в рабочей таблице его разбирает autovacuum
+                for index in ('user_email_trgm_idx', 'user_city_trgm_idx'):
+                    cursor.execute('SELECT gin_clean_pending_list(%s::regclass)', [index])
+                cursor.execute(f'ANALYZE {table}')
+            self.stdout.write(f'Создано {options["users"]} пользователей за {time.monotonic() - started:.2f} с')
+
+            user = User.objects.order_by('id').first()
+            over_budget = []
+            email = hashlib.md5(b'777777').hexdigest()[:12]
+            for params in ({}, {'search': email}, {'search': email[:6]}, {'search': 'yandex'}, {'search': 'тюм'},
+                           {'search': 'no-such-user'}, {'city': 'Пермь'}, {'email': f'{email}@mail.ru'}):
+                timings = [self.request(user, params) for _ in range(options['repeat'])]
+                median = statistics.median(timings)
+                self.stdout.write(f'{params or "без фильтров"}: медиана {median:.1f} мс, максимум {max(timings):.1f} мс')
+                if median > options['budget_ms']:
+                    over_budget.append(str(params))
+                    self.stdout.write(self.explain(user, params))
+            transaction.set_rollback(True)
+        if over_budget:
+            self.stdout.write(self.style.WARNING(f'Превышен бюджет {options["budget_ms"]} мс: {", ".join(over_budget)}'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Все запросы укладываются в {options["budget_ms"]} мс'))
+
+    def request(self, user, params):
+        request = APIRequestFactory().get('/users/', params)
+        force_authenticate(request, user=user)
+        started = time.monotonic()
+        response = UserListAPIView.as_view()(request)
+        response.render()
+        return (time.monotonic() - started) * 1000
+
+    def explain(self, user, params):
+        view = UserListAPIView()
+        view.args, view.kwargs, view.format_kwarg = (), {}, None
+        view.request = view.initialize_request(APIRequestFactory().get('/users/', params))
+        view.request.user = user
+        return view.filter_queryset(view.get_queryset()).order_by('id')[:21].explain(analyze=True)
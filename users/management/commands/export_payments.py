@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from users.exports import export_payments, EXPORTERS
+from users.filters import PaymentFilter
+from users.models import Payment
+
+
+class Command(BaseCommand):
+    help = 'Выгружает платежи в csv или ndjson потоково, с фильтрами как у /payment/'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', dest='export_format', choices=list(EXPORTERS), default='csv')
+        parser.add_argument('--output', help='Файл для выгрузки (по умолчанию stdout)')
+        parser.add_argument('--course', help='ID курса')
+        parser.add_argument('--lesson', help='ID урока')
+        parser.add_argument('--payment-method', choices=['cash', 'card'])
+        parser.add_argument('--date-after', help='Дата оплаты от (ISO 8601), включительно')
+        parser.add_argument('--date-before', help='Дата оплаты до (ISO 8601), не включительно')
+        parser.add_argument('--chunk-size', type=int, default=settings.PAYMENT_EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        data = {name: options[name] for name in ('course', 'lesson', 'payment_method', 'date_after', 'date_before')
+                if options[name] is not None}
+        payment_filter = PaymentFilter(data=data, queryset=Payment.objects.order_by('id'))
+        if not payment_filter.is_valid():
+            raise CommandError(payment_filter.errors.as_text())
+        lines = export_payments(payment_filter.qs, options['export_format'], options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(lines)
+        else:
+            self.stdout.ending = ''
+            for line in lines:
+                self.stdout.write(line)
@@ -0,0 +1,43 @@
+# Generated by Django 4.2 on 2026-10-18 08:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0006_hot_path_indexes'),
+        ('users', '0005_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripePrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.PositiveIntegerField(verbose_name='Сумма')),
+                ('currency', models.CharField(default='rub', max_length=3, verbose_name='Валюта')),
+                ('product_id', models.CharField(max_length=255, verbose_name='ID продукта в Stripe')),
+                ('price_id', models.CharField(max_length=255, unique=True, verbose_name='ID цены в Stripe')),
+                ('course', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='materials.course', verbose_name='Курс')),
+                ('lesson', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='materials.lesson', verbose_name='Урок')),
+            ],
+            options={
+                'verbose_name': 'Цена в Stripe',
+                'verbose_name_plural': 'Цены в Stripe',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='stripeprice',
+            constraint=models.UniqueConstraint(condition=models.Q(('course__isnull', False)), fields=('course', 'amount', 'currency'), name='unique_stripe_price_course'),
+        ),
+        migrations.AddConstraint(
+            model_name='stripeprice',
+            constraint=models.UniqueConstraint(condition=models.Q(('lesson__isnull', False)), fields=('lesson', 'amount', 'currency'), name='unique_stripe_price_lesson'),
+        ),
+        migrations.AddConstraint(
+            model_name='stripeprice',
+            constraint=models.CheckConstraint(check=models.Q(('course__isnull', True), ('lesson__isnull', True), _connector='XOR'), name='stripe_price_course_xor_lesson'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2 on 2026-10-18 08:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_stripe_price'),
+    ]
+
+    operations = [
+        # Существующие платежи создавались синхронно, сессия у них уже есть
+        migrations.AddField(
+            model_name='payment',
+            name='checkout_status',
+            field=models.CharField(choices=[('pending', 'Создается'), ('created', 'Создана'), ('failed', 'Ошибка')], default='created', max_length=10, verbose_name='Статус сессии оплаты'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='checkout_status',
+            field=models.CharField(choices=[('pending', 'Создается'), ('created', 'Создана'), ('failed', 'Ошибка')], default='pending', max_length=10, verbose_name='Статус сессии оплаты'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-18 08:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_payment_checkout_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='payment_status',
+            field=models.CharField(blank=True, max_length=20, null=True, verbose_name='Статус оплаты в stripe'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='session_status',
+            field=models.CharField(blank=True, max_length=20, null=True, verbose_name='Статус сессии в stripe'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='status_updated_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Дата обновления статуса'),
+        ),
+    ]
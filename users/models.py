@@ -1,5 +1,7 @@
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.db import models
+from django.db.models.functions import Upper
 
 from materials.models import Course, Lesson
 
@@ -23,9 +25,29 @@ class User(AbstractUser):
     class Meta:
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
+        indexes = [
+            models.Index(fields=['last_login'], condition=models.Q(is_active=True),
+                         name='user_active_last_login_idx'),
+            models.Index(fields=['date_joined'], condition=models.Q(is_active=True, last_login__isnull=True),
+                         name='user_active_never_login_idx'),
+            # Поиск ?search= идет через icontains, то есть UPPER(поле) LIKE '%...%'
+            GinIndex(OpClass(Upper('email'), name='gin_trgm_ops'), name='user_email_trgm_idx'),
+            GinIndex(OpClass(Upper('city'), name='gin_trgm_ops'), name='user_city_trgm_idx'),
+            models.Index(fields=['city'], name='user_city_idx'),
+            models.Index(fields=['phone'], name='user_phone_idx'),
+        ]
 
 
 class Payment(models.Model):
+    CHECKOUT_PENDING = 'pending'
+    CHECKOUT_CREATED = 'created'
+    CHECKOUT_FAILED = 'failed'
+    CHECKOUT_STATUSES = [
+        (CHECKOUT_PENDING, 'Создается'),
+        (CHECKOUT_CREATED, 'Создана'),
+        (CHECKOUT_FAILED, 'Ошибка'),
+    ]
+
     summ = models.PositiveIntegerField(verbose_name='Сумма оплаты')
     session_id = models.CharField(max_length=255, verbose_name='ID Сессии', **NULLABLE)
     payment_link = models.URLField(max_length=400, verbose_name='Ссылка на оплату', **NULLABLE)
@@ -34,6 +56,12 @@ class Payment(models.Model):
     course = models.ForeignKey(Course, on_delete=models.CASCADE, verbose_name='Оплаченный курс', **NULLABLE)
     lesson = models.ForeignKey(Lesson, on_delete=models.CASCADE, verbose_name='Оплаченный урок', **NULLABLE)
     payment_method = models.CharField(choices=[('cash', 'Наличные'), ('card', 'Картой')], **NULLABLE)
+    checkout_status = models.CharField(max_length=10, choices=CHECKOUT_STATUSES, default=CHECKOUT_PENDING,
+                                       verbose_name='Статус сессии оплаты')
+    payment_status = models.CharField(max_length=20, verbose_name='Статус оплаты в stripe', **NULLABLE)
+    session_status = models.CharField(max_length=20, verbose_name='Статус сессии в stripe', **NULLABLE)
+    status_updated_at = models.DateTimeField(verbose_name='Дата обновления статуса', **NULLABLE)
+    idempotency_key = models.CharField(max_length=255, verbose_name='Ключ идемпотентности', **NULLABLE)
 
     def __str__(self):
         return f'{self.user} - {self.summ}'
@@ -41,3 +69,42 @@ class Payment(models.Model):
     class Meta:
         verbose_name = 'Платеж'
         verbose_name_plural = 'Платежи'
+        indexes = [
+            models.Index(fields=['course', '-date'], condition=models.Q(course__isnull=False),
+                         name='payment_course_date_idx'),
+            models.Index(fields=['lesson', '-date'], condition=models.Q(lesson__isnull=False),
+                         name='payment_lesson_date_idx'),
+            models.Index(fields=['payment_method', '-date'], name='payment_method_date_idx'),
+            models.Index(fields=['-date'], name='payment_date_idx'),
+            models.Index(fields=['user', '-id'], name='payment_user_id_idx'),
+            models.Index(fields=['user', '-date'], name='payment_user_date_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'idempotency_key'],
+                                    condition=models.Q(idempotency_key__isnull=False),
+                                    name='unique_payment_idempotency_key'),
+        ]
+
+
+class StripePrice(models.Model):
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, verbose_name='Курс', **NULLABLE)
+    lesson = models.ForeignKey(Lesson, on_delete=models.CASCADE, verbose_name='Урок', **NULLABLE)
+    amount = models.PositiveIntegerField(verbose_name='Сумма')
+    currency = models.CharField(max_length=3, default='rub', verbose_name='Валюта')
+    product_id = models.CharField(max_length=255, verbose_name='ID продукта в Stripe')
+    price_id = models.CharField(max_length=255, unique=True, verbose_name='ID цены в Stripe')
+
+    def __str__(self):
+        return f'{self.course or self.lesson} - {self.amount} {self.currency}'
+
+    class Meta:
+        verbose_name = 'Цена в Stripe'
+        verbose_name_plural = 'Цены в Stripe'
+        constraints = [
+            models.UniqueConstraint(fields=['course', 'amount', 'currency'], condition=models.Q(course__isnull=False),
+                                    name='unique_stripe_price_course'),
+            models.UniqueConstraint(fields=['lesson', 'amount', 'currency'], condition=models.Q(lesson__isnull=False),
+                                    name='unique_stripe_price_lesson'),
+            models.CheckConstraint(check=models.Q(course__isnull=True) ^ models.Q(lesson__isnull=True),
+                                   name='stripe_price_course_xor_lesson'),
+        ]
@@ -0,0 +1,17 @@
+from rest_framework.pagination import CursorPagination
+
+
+class PaymentPaginator(CursorPagination):
+    """Постраничный вывод платежей по курсору (keyset) без COUNT(*) и OFFSET"""
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-id'
+
+
+class UserPaginator(CursorPagination):
+    """Постраничный вывод пользователей по курсору (keyset) без COUNT(*) и OFFSET"""
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = 'id'
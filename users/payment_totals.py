@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Sum
+
+from users.models import Payment
+
+
+def get_payment_totals_cache_key(user_id):
+    """Возвращает ключ кэша итогов по платежам пользователя"""
+    return f'user_payment_totals:{user_id}'
+
+
+def load_payment_totals(user_id):
+    """Возвращает количество и сумму платежей пользователя без неудавшихся из кэша или из БД"""
+    key = get_payment_totals_cache_key(user_id)
+    timeout = settings.USER_PAYMENT_TOTALS_CACHE_TIMEOUT
+    totals = cache.get(key) if timeout else None
+    if totals is None:
+        totals = Payment.objects.filter(user_id=user_id).exclude(
+            checkout_status=Payment.CHECKOUT_FAILED
+        ).aggregate(count=Count('id'), summ=Sum('summ'))
+        totals['summ'] = totals['summ'] or 0
+        if timeout:
+            cache.set(key, totals, timeout)
+    return totals
+
+
+def invalidate_payment_totals(user_ids):
+    """Сбрасывает кэш итогов по платежам пользователей"""
+    cache.delete_many([get_payment_totals_cache_key(user_id) for user_id in user_ids if user_id is not None])
@@ -1,17 +1,19 @@
 from rest_framework.permissions import BasePermission
 
+from users.roles import is_moderator
+
 
 class IsModerator(BasePermission):
     """Проверяет, является ли пользователь модератором"""
     def has_permission(self, request, view):
-        return request.user.groups.filter(name='moderator').exists()
+        return is_moderator(request)
 
 
 class IsOwner(BasePermission):
     """Проверяет, является ли пользователь владельцем"""
 
     def has_object_permission(self, request, view, obj):
-        return obj.user == request.user
+        return request.user.is_authenticated and obj.user_id == request.user.pk
 
 class IsSelfUser(BasePermission):
     """Проверяет, является ли пользователь собой"""
@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.core.cache import cache
+
+MODERATOR = 'moderator'
+
+
+def get_roles_cache_key(user_id):
+    """Возвращает ключ кэша ролей пользователя"""
+    return f'user_roles:{user_id}'
+
+
+def load_user_roles(user):
+    """Загружает роли (названия групп) пользователя из кэша или из БД"""
+    if not user or not user.is_authenticated:
+        return frozenset()
+    timeout = settings.USER_ROLES_CACHE_TIMEOUT
+    if timeout:
+        roles = cache.get(get_roles_cache_key(user.pk))
+        if roles is not None:
+            return roles
+    roles = frozenset(user.groups.values_list('name', flat=True))
+    if timeout:
+        cache.set(get_roles_cache_key(user.pk), roles, timeout)
+    return roles
+
+
+def get_user_roles(request):
+    """Возвращает роли текущего пользователя, вычисляя их не более одного раза за запрос"""
+    http_request = getattr(request, '_request', request)
+    roles = getattr(http_request, '_user_roles', None)
+    if roles is None:
+        roles = load_user_roles(request.user)
+        http_request._user_roles = roles
+    return roles
+
+
+def is_moderator(request):
+    """Проверяет, является ли текущий пользователь модератором"""
+    return MODERATOR in get_user_roles(request)
+
+
+def invalidate_user_roles(user_ids):
+    """Сбрасывает закэшированные роли пользователей"""
+    cache.delete_many([get_roles_cache_key(user_id) for user_id in user_ids])
@@ -1,17 +1,45 @@
+from django.conf import settings
+from django.contrib.auth.models import update_last_login
 from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
+from users.last_login import record_last_login
 from users.models import User, Payment
+from users.payment_totals import load_payment_totals
 
 
 class PaymentSerializer(serializers.ModelSerializer):
 
+    def validate(self, attrs):
+        course = attrs.get('course', self.instance.course if self.instance else None)
+        lesson = attrs.get('lesson', self.instance.lesson if self.instance else None)
+        if course is None and lesson is None:
+            raise ValidationError('Выберите курс или урок для оплаты')
+        elif course is not None and lesson is not None:
+            raise ValidationError('Выберите только один курс или урок для оплаты')
+        return attrs
+
     class Meta:
         model = Payment
         fields = '__all__'
+        read_only_fields = ('user', 'session_id', 'payment_link', 'checkout_status', 'payment_status', 'session_status',
+                            'status_updated_at', 'idempotency_key')
 
 
 class SelfUserSerializer(serializers.ModelSerializer):
-    payments = PaymentSerializer(many=True, source='payment_set')
+    payments = serializers.SerializerMethodField()
+    payments_total = serializers.SerializerMethodField()
+
+    def get_payments(self, obj):
+        """Последние платежи пользователя, полная история - в /users/<pk>/payments/"""
+        payments = getattr(obj, 'recent_payments', None)
+        if payments is None:
+            payments = obj.payment_set.order_by('-id')[:settings.USER_RECENT_PAYMENTS]
+        return PaymentSerializer(payments, many=True).data
+
+    def get_payments_total(self, obj):
+        return load_payment_totals(obj.pk)
 
     class Meta:
         model = User
@@ -29,3 +57,15 @@ class UserRegisterSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = '__all__'
+
+
+class LastLoginTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """Выдает пару токенов и откладывает запись last_login в буфер вместо UPDATE в БД, если есть общий кэш"""
+
+    def validate(self, attrs):
+        data = super().validate(attrs)
+        if settings.LAST_LOGIN_BUFFERED:
+            record_last_login(self.user.pk)
+        else:
+            update_last_login(None, self.user)
+        return data
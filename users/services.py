@@ -1,38 +1,325 @@
+import datetime
+import functools
+import hashlib
+import logging
+import math
 import os
+import time
 from dotenv import load_dotenv
 import stripe
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
 from config.settings import BASE_DIR
+from materials.models import Course
+from users.models import StripePrice, Payment
+from users.stripe_client import PooledRequestsClient
 
 load_dotenv(BASE_DIR / '.env', override=True)
 stripe.api_key = os.getenv('stripe_api_key')
+stripe.max_network_retries = settings.STRIPE_MAX_NETWORK_RETRIES
+stripe.default_http_client = PooledRequestsClient(
+    connect_timeout=settings.STRIPE_CONNECT_TIMEOUT,
+    read_timeout=settings.STRIPE_READ_TIMEOUT,
+    pool_size=settings.STRIPE_POOL_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+STRIPE_PRICE_CACHE_SIZE = 1024
+FINAL_SESSION_STATUSES = ('complete', 'expired')
+_price_cache = {}
+
+
+class StripeUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Платежный сервис временно недоступен, попробуйте позже'
+    default_code = 'stripe_unavailable'
+
+    def __init__(self, wait=None):
+        super().__init__()
+        # exception_handler DRF превращает wait в заголовок Retry-After
+        self.wait = wait
+
+
+class CircuitBreaker:
+    """
+    Размыкатель цепи для внешнего сервиса: после доли ошибок и медленных вызовов выше порога
+    вызовы сразу завершаются StripeUnavailable, через recovery_timeout пропускается один пробный вызов.
+    Состояние хранится в кеше Django, с Redis оно общее для всех воркеров
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+    errors = (stripe.APIConnectionError, stripe.APIError, stripe.RateLimitError)
+
+    def __init__(self, name):
+        self.name = name
+
+    def key(self, suffix):
+        return f'circuit:{self.name}:{suffix}'
+
+    def window_key(self, suffix, now):
+        return self.key(f'{suffix}:{int(now // settings.STRIPE_BREAKER_WINDOW)}')
+
+    def incr(self, key, timeout=None):
+        cache.add(key, 0, timeout)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            cache.add(key, 1, timeout)
+            return 1
 
+    def get_state(self, now=None):
+        opened_at = cache.get(self.key('opened_at'))
+        if opened_at is None:
+            return self.CLOSED
+        if (now or time.time()) - opened_at < settings.STRIPE_BREAKER_RECOVERY_TIMEOUT:
+            return self.OPEN
+        return self.HALF_OPEN
 
+    def transition(self, old_state, new_state):
+        self.incr(self.key(f'transitions:{old_state}:{new_state}'))
+        logger.warning('Размыкатель %s: %s -> %s', self.name, old_state, new_state)
+
+    def before_call(self):
+        """Возвращает True для пробного вызова, для разомкнутой цепи выбрасывает StripeUnavailable"""
+        now = time.time()
+        state = self.get_state(now)
+        if state == self.CLOSED:
+            return False
+        recovery_timeout = settings.STRIPE_BREAKER_RECOVERY_TIMEOUT
+        if state == self.HALF_OPEN and cache.add(self.key('probe'), 1, recovery_timeout):
+            self.transition(self.OPEN, self.HALF_OPEN)
+            return True
+        self.incr(self.key('rejected'))
+        opened_at = cache.get(self.key('opened_at')) or now
+        raise StripeUnavailable(wait=max(math.ceil(opened_at + recovery_timeout - now), 1))
+
+    def on_success(self, probe):
+        if probe:
+            cache.delete_many([self.key('opened_at'), self.key('probe')])
+            self.transition(self.HALF_OPEN, self.CLOSED)
+
+    def on_failure(self, probe):
+        now = time.time()
+        if probe:
+            cache.set(self.key('opened_at'), now, None)
+            cache.delete(self.key('probe'))
+            self.transition(self.HALF_OPEN, self.OPEN)
+            return
+        window = settings.STRIPE_BREAKER_WINDOW * 2
+        failures = self.incr(self.window_key('failures', now), window)
+        calls = cache.get(self.window_key('calls', now)) or failures
+        if calls >= settings.STRIPE_BREAKER_MIN_CALLS and failures / calls >= settings.STRIPE_BREAKER_FAILURE_RATE:
+            if cache.add(self.key('opened_at'), now, None):
+                self.transition(self.CLOSED, self.OPEN)
+
+    def raise_if_open(self):
+        """Завершает запрос сразу, если цепь разомкнута и пробный вызов сейчас не нужен"""
+        if self.get_state() == self.OPEN:
+            self.before_call()
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            probe = self.before_call()
+            now = time.time()
+            if not probe:
+                self.incr(self.window_key('calls', now), settings.STRIPE_BREAKER_WINDOW * 2)
+            try:
+                result = func(*args, **kwargs)
+            except self.errors:
+                self.on_failure(probe)
+                raise
+            except BaseException:
+                if probe:
+                    cache.delete(self.key('probe'))
+                raise
+            if time.time() - now > settings.STRIPE_BREAKER_SLOW_CALL:
+                self.on_failure(probe)
+            else:
+                self.on_success(probe)
+            return result
+        return wrapper
+
+    def get_metrics(self):
+        """Текущее состояние, счетчики вызовов в окне и число переходов между состояниями"""
+        now = time.time()
+        transitions = [(self.CLOSED, self.OPEN), (self.OPEN, self.HALF_OPEN),
+                       (self.HALF_OPEN, self.OPEN), (self.HALF_OPEN, self.CLOSED)]
+        counters = cache.get_many([self.window_key('calls', now), self.window_key('failures', now),
+                                   self.key('rejected')] + [self.key(f'transitions:{a}:{b}') for a, b in transitions])
+        return {
+            'name': self.name,
+            'state': self.get_state(now),
+            'calls': counters.get(self.window_key('calls', now), 0),
+            'failures': counters.get(self.window_key('failures', now), 0),
+            'rejected': counters.get(self.key('rejected'), 0),
+            'transitions': {f'{a}->{b}': counters.get(self.key(f'transitions:{a}:{b}'), 0) for a, b in transitions},
+        }
+
+
+stripe_breaker = CircuitBreaker('stripe')
+
+
+@stripe_breaker
 def create_product(product):
     """Создает продукт"""
     return stripe.Product.create(name=f"{product}")
 
 
-def create_price(price, product):
+@stripe_breaker
+def create_price(price, product, currency='rub'):
     """Создает цену в stripe."""
     return stripe.Price.create(
-        currency="rub",
+        currency=currency,
         unit_amount=price * 100,
         product=product.get('id')
     )
 
 
-def create_session(price):
+def get_price_cache_key(item, amount, currency):
+    return item._meta.model_name, item.pk, amount, currency
+
+
+def clear_price_cache():
+    _price_cache.clear()
+
+
+def get_stripe_price_id(item, amount, currency='rub'):
+    """Возвращает ID цены в stripe для курса или урока, создавая продукт и цену только при первой покупке"""
+    key = get_price_cache_key(item, amount, currency)
+    price_id = _price_cache.get(key)
+    if price_id is not None:
+        return price_id
+
+    item_field = 'course' if isinstance(item, Course) else 'lesson'
+    prices = StripePrice.objects.filter(**{item_field: item})
+    price_id = prices.filter(amount=amount, currency=currency).values_list('price_id', flat=True).first()
+    if price_id is None:
+        product_id = prices.values_list('product_id', flat=True).first()
+        if product_id is None:
+            product_id = create_product(item).get('id')
+        price_id = create_price(price=amount, product={'id': product_id}, currency=currency).get('id')
+        try:
+            with transaction.atomic():
+                StripePrice.objects.create(**{item_field: item}, amount=amount, currency=currency,
+                                           product_id=product_id, price_id=price_id)
+        except IntegrityError:
+            # Параллельный запрос успел сохранить цену раньше - используем ее
+            price_id = prices.filter(amount=amount, currency=currency).values_list('price_id', flat=True).get()
+
+    if len(_price_cache) >= STRIPE_PRICE_CACHE_SIZE:
+        _price_cache.clear()
+    _price_cache[key] = price_id
+    return price_id
+
+
+@stripe_breaker
+def create_session(price_id, idempotency_key=None):
     """Создает сессию для оплаты"""
-    session = stripe.checkout.Session.create(
+    return stripe.checkout.Session.create(
         success_url="http://127.0.0.1:8000/",
-        line_items=[{"price": price.get('id'), "quantity": 1}],
+        line_items=[{"price": price_id, "quantity": 1}],
         mode="payment",
+        idempotency_key=idempotency_key,
     )
-    return session.get('id'), session.get('url'), session.get('payment_method_types')[0]
 
 
+def get_idempotency_cache_key(user_id, idempotency_key):
+    return f'payment_idempotency:{user_id}:{hashlib.sha256(idempotency_key.encode()).hexdigest()}'
+
+
+def create_payment_checkout_session(payment):
+    """Создает сессию оплаты в stripe для платежа и сохраняет ссылку на оплату"""
+    price_id = get_stripe_price_id(payment.course or payment.lesson, payment.summ)
+    idempotency_key = None
+    if payment.idempotency_key:
+        idempotency_key = f'payment-session-{payment.user_id}-{payment.idempotency_key}'
+    session = create_session(price_id, idempotency_key=idempotency_key)
+    payment.session_id = session.get('id')
+    payment.payment_link = session.get('url')
+    payment.payment_method = session.get('payment_method_types')[0]
+    payment.checkout_status = Payment.CHECKOUT_CREATED
+    payment.payment_status = session.get('payment_status')
+    payment.session_status = session.get('status')
+    payment.status_updated_at = timezone.now()
+    payment.save(update_fields=['session_id', 'payment_link', 'payment_method', 'checkout_status',
+                                'payment_status', 'session_status', 'status_updated_at'])
+    return payment
+
+
+@stripe_breaker
 def get_payment_status(payment_id):
     response = stripe.checkout.Session.retrieve(
         payment_id
     )
     return response.get('payment_status'), response.get('status')
+
+
+@stripe_breaker
+def list_checkout_sessions(created_gte, limit, starting_after=None):
+    """Возвращает страницу сессий оплаты stripe, созданных не раньше created_gte"""
+    params = {'created': {'gte': created_gte}, 'limit': limit}
+    if starting_after:
+        params['starting_after'] = starting_after
+    return stripe.checkout.Session.list(**params)
+
+
+def iter_checkout_session_pages(created_gte, limit):
+    """Перебирает страницы сессий stripe; каждая страница - один запрос через размыкатель цепи"""
+    starting_after = None
+    while True:
+        page = list_checkout_sessions(created_gte, limit, starting_after)
+        yield page.data
+        if not page.has_more or not page.data:
+            return
+        starting_after = page.data[-1].id
+
+
+def update_payment_status(session_id, payment_status, session_status, updated_at):
+    """Сохраняет статус сессии stripe, если он не старее уже сохраненного (итоговый статус сохраняется всегда)"""
+    payments = Payment.objects.filter(session_id=session_id)
+    if session_status not in FINAL_SESSION_STATUSES:
+        payments = payments.filter(Q(status_updated_at__isnull=True) | Q(status_updated_at__lte=updated_at))
+    return payments.update(payment_status=payment_status, session_status=session_status, status_updated_at=updated_at)
+
+
+def is_payment_status_stale(payment):
+    """Статус устарел, если сессия еще открыта и давно не обновлялась"""
+    if payment.session_status in FINAL_SESSION_STATUSES:
+        return False
+    if payment.status_updated_at is None:
+        return True
+    max_age = datetime.timedelta(seconds=settings.PAYMENT_STATUS_STALE_AFTER)
+    return timezone.now() - payment.status_updated_at > max_age
+
+
+def refresh_payment_status(payment):
+    """Возвращает статус платежа из БД, запрашивая stripe только для устаревшего статуса"""
+    if payment.checkout_status == Payment.CHECKOUT_CREATED and is_payment_status_stale(payment):
+        try:
+            payment.payment_status, payment.session_status = get_payment_status(payment.session_id)
+        except StripeUnavailable:
+            # Пока stripe недоступен, отдаем последний известный статус
+            return payment.payment_status, payment.session_status
+        except stripe.StripeError:
+            logger.exception('Платеж %s: не удалось получить статус сессии оплаты', payment.pk)
+            return payment.payment_status, payment.session_status
+        payment.status_updated_at = timezone.now()
+        update_payment_status(payment.session_id, payment.payment_status, payment.session_status,
+                              payment.status_updated_at)
+    return payment.payment_status, payment.session_status
+
+
+def handle_stripe_event(event):
+    """Обновляет статус платежа по событию checkout.session.* из вебхука stripe"""
+    if not event['type'].startswith('checkout.session.'):
+        return 0
+    session = event['data']['object']
+    updated_at = datetime.datetime.fromtimestamp(event['created'], tz=datetime.timezone.utc)
+    return update_payment_status(session['id'], session.get('payment_status'), session.get('status'), updated_at)
@@ -0,0 +1,42 @@
+from django.contrib.auth.models import Group
+from django.db.models.signals import m2m_changed, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from users.authentication import invalidate_user_auth
+from users.models import User, Payment
+from users.payment_totals import invalidate_payment_totals
+from users.roles import invalidate_user_roles
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_roles_on_groups_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Сбрасывает кэш ролей при изменении состава групп пользователя"""
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_user_roles([instance.pk])
+    elif action == 'pre_clear':
+        invalidate_user_roles(instance.user_set.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove') and pk_set:
+        invalidate_user_roles(pk_set)
+
+
+@receiver(post_save, sender=Group)
+@receiver(pre_delete, sender=Group)
+def invalidate_roles_on_group_change(sender, instance, **kwargs):
+    """Сбрасывает кэш ролей участников группы при ее переименовании или удалении"""
+    if instance.pk:
+        invalidate_user_roles(instance.user_set.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def invalidate_payment_totals_on_change(sender, instance, **kwargs):
+    """Сбрасывает кэш итогов по платежам владельца платежа"""
+    invalidate_payment_totals([instance.user_id])
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_auth_on_change(sender, instance, **kwargs):
+    """Сбрасывает кэш пользователя для аутентификации при его изменении или удалении"""
+    invalidate_user_auth([instance.pk])
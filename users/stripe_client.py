@@ -0,0 +1,67 @@
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class PooledRequestsClient(stripe.RequestsClient):
+    """HTTP клиент stripe с пулом keep-alive соединений, таймаутами и замером задержки запросов"""
+
+    def __init__(self, connect_timeout, read_timeout, pool_size, **kwargs):
+        super().__init__(timeout=(connect_timeout, read_timeout), **kwargs)
+        self.pool_size = pool_size
+        self.pid = os.getpid()
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {'requests': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+
+    def new_session(self):
+        """Создает сессию requests с пулом соединений, повторы запросов делает сам stripe"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_session(self):
+        """Возвращает сессию потока; после fork (воркеры celery, gunicorn) пул создается заново"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._thread_local = threading.local()
+        if getattr(self._thread_local, 'session', None) is None:
+            self._thread_local.session = self.new_session()
+        return self._thread_local.session
+
+    def request(self, method, url, headers, post_data=None):
+        self.get_session()
+        started = time.monotonic()
+        failed = True
+        try:
+            response = super().request(method, url, headers, post_data)
+            failed = False
+            return response
+        finally:
+            elapsed = time.monotonic() - started
+            with self.stats_lock:
+                self.stats['requests'] += 1
+                self.stats['errors'] += failed
+                self.stats['seconds'] += elapsed
+                self.stats['max_seconds'] = max(self.stats['max_seconds'], elapsed)
+            logger.info('stripe %s %s: %.1f мс%s', method.upper(), urlsplit(url).path,
+                        elapsed * 1000, ' (ошибка)' if failed else '')
+
+    def close(self):
+        session = getattr(self._thread_local, 'session', None)
+        if session is not None:
+            session.close()
+            self._thread_local.session = None
@@ -0,0 +1,117 @@
+import datetime
+import logging
+import time
+
+import stripe
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from users.last_login import flush_last_login_buffer
+from users.models import Payment
+from users.payment_totals import invalidate_payment_totals
+from users.services import create_payment_checkout_session, StripeUnavailable, FINAL_SESSION_STATUSES, \
+    iter_checkout_session_pages
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task(bind=True, max_retries=3)
+def create_payment_checkout(self, payment_id):
+    """Создает в фоне сессию оплаты stripe для платежа в статусе pending"""
+    payment = Payment.objects.select_related('course', 'lesson').filter(
+        pk=payment_id,
+        checkout_status=Payment.CHECKOUT_PENDING
+    ).first()
+    if payment is None:
+        return None
+    try:
+        create_payment_checkout_session(payment)
+    except StripeUnavailable as exc:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc, countdown=exc.wait)
+        logger.warning('Платеж %s: stripe недоступен, размыкатель цепи разомкнут', payment_id)
+    except stripe.APIConnectionError as exc:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc, countdown=2 ** self.request.retries)
+        logger.exception('Платеж %s: stripe недоступен', payment_id)
+    except stripe.StripeError:
+        logger.exception('Платеж %s: не удалось создать сессию оплаты', payment_id)
+    else:
+        return payment.checkout_status
+    Payment.objects.filter(pk=payment_id).update(checkout_status=Payment.CHECKOUT_FAILED)
+    # UPDATE не вызывает сигналы, а неудавшийся платеж не входит в итоги профиля
+    invalidate_payment_totals([payment.user_id])
+    return Payment.CHECKOUT_FAILED
+
+
+@shared_task
+def reconcile_pending_payments():
+    """Сверяет статусы открытых сессий оплаты постраничным списком сессий stripe и сохраняет изменения пачкой"""
+    started = time.monotonic()
+    payments = {
+        payment.session_id: payment
+        for payment in Payment.objects.filter(
+            checkout_status=Payment.CHECKOUT_CREATED,
+            session_id__isnull=False
+        ).exclude(
+            session_status__in=FINAL_SESSION_STATUSES
+        ).only('session_id', 'date', 'payment_status', 'session_status', 'status_updated_at')
+    }
+    pages = 0
+    changed = []
+    snapshot = {}
+    if payments:
+        now = timezone.now()
+        oldest = min((payment.date for payment in payments.values() if payment.date),
+                     default=now - datetime.timedelta(days=1))
+        remaining = set(payments)
+        # Сессии в списке stripe идут от новых к старым, запрашиваем только созданные после самого старого платежа
+        created_gte = int(oldest.timestamp()) - 60
+        for sessions in iter_checkout_session_pages(created_gte, settings.PAYMENT_RECONCILE_PAGE_SIZE):
+            pages += 1
+            for session in sessions:
+                payment = payments.get(session.id)
+                if payment is None:
+                    continue
+                remaining.discard(session.id)
+                if (payment.payment_status, payment.session_status) != (session.payment_status, session.status):
+                    snapshot[payment.pk] = payment.status_updated_at
+                    payment.payment_status = session.payment_status
+                    payment.session_status = session.status
+                    payment.status_updated_at = now
+                    changed.append(payment)
+            if not remaining:
+                break
+        if changed:
+            with transaction.atomic():
+                # Вебхук или чтение статуса могли сохранить более новый статус после выборки,
+                # такие платежи не перезаписываем (как в update_payment_status)
+                current = Payment.objects.select_for_update().filter(
+                    pk__in=snapshot
+                ).values_list('pk', 'session_status', 'status_updated_at')
+                moved = {
+                    pk for pk, session_status, status_updated_at in current
+                    if session_status in FINAL_SESSION_STATUSES or status_updated_at != snapshot[pk]
+                }
+                changed = [payment for payment in changed if payment.pk not in moved]
+                Payment.objects.bulk_update(changed, ['payment_status', 'session_status', 'status_updated_at'],
+                                            batch_size=500)
+    elapsed = time.monotonic() - started
+    logger.info('Сверка платежей: %s открытых, %s страниц stripe, обновлено %s за %.3f с',
+                len(payments), pages, len(changed), elapsed)
+    return {'pending': len(payments), 'pages': pages, 'updated': len(changed), 'seconds': elapsed}
+
+
+@shared_task
+def flush_last_logins():
+    """Сохраняет накопленное в кэше время входа пользователей в БД"""
+    started = time.monotonic()
+    result = flush_last_login_buffer()
+    if result is None:
+        logger.info('Сохранение времени входа уже выполняется')
+        return None
+    result['seconds'] = time.monotonic() - started
+    logger.info('Сохранение времени входа пользователей: %s', result)
+    return result
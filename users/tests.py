@@ -1,11 +1,39 @@
+import csv
 import datetime
+import io
+import json
+import threading
+import time
+from unittest import mock
 
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+import stripe
 
-from materials.models import Course
-from users.models import User, Payment
+from config.celery import app as celery_app
+
+from materials.models import Course, Lesson
+from materials.tasks import check_user_activity
+from users.authentication import clear_local_user_auth
+from users.fake_stripe import FakeStripeServer, sign_webhook_payload, make_webhook_event
+from users.last_login import record_last_login, flush_last_login_buffer, LAST_LOGIN_SEQUENCE_KEY, \
+    LAST_LOGIN_LOCK_KEY
+from users.models import User, Payment, StripePrice
+from users.payment_totals import load_payment_totals
+from users.serializes import PaymentSerializer
+from users.services import clear_price_cache, CircuitBreaker, StripeUnavailable, stripe_breaker, \
+    get_idempotency_cache_key, iter_checkout_session_pages, update_payment_status
+from users.stripe_client import PooledRequestsClient
+from users.tasks import flush_last_logins, reconcile_pending_payments
 
 
 # Create your tests here.
@@ -65,24 +93,40 @@ class UserTestCase(APITestCase):
         )
         self.assertEqual(
             response.json(),
-            [
-                {
-                    "id": self.user.pk,
-                    "email": "test@test.com",
-                    "phone": None,
-                    "city": None,
-                    "avatar": None
-                },
-                {
-                    "id": self.another_user.pk,
-                    "email": "another@email.com",
-                    "phone": None,
-                    "city": None,
-                    "avatar": None
-                },
-            ]
+            {
+                "next": None,
+                "previous": None,
+                "results": [
+                    {
+                        "id": self.user.pk,
+                        "email": "test@test.com",
+                        "phone": None,
+                        "city": None,
+                        "avatar": None
+                    },
+                    {
+                        "id": self.another_user.pk,
+                        "email": "another@email.com",
+                        "phone": None,
+                        "city": None,
+                        "avatar": None
+                    },
+                ]
+            }
         )
 
+    def test_user_search(self):
+        """Поиск пользователей по части email и города без учета регистра и точные фильтры"""
+        User.objects.create(email='ivanov@mail.ru', city='Екатеринбург', phone='+79000000000')
+        User.objects.create(email='petrov@mail.ru', city='Москва')
+        for params, emails in (({'search': 'IVAN'}, ['ivanov@mail.ru']),
+                               ({'search': 'мос'}, ['petrov@mail.ru']),
+                               ({'search': 'mail.ru'}, ['ivanov@mail.ru', 'petrov@mail.ru']),
+                               ({'city': 'Москва'}, ['petrov@mail.ru']),
+                               ({'phone': '+79000000000'}, ['ivanov@mail.ru'])):
+            response = self.client.get('/users/', params)
+            self.assertEqual([user['email'] for user in response.json()['results']], emails)
+
     def test_self_user_detail(self):
         """Тестирование вывода одного текущего пользователя"""
         response = self.client.get(
@@ -109,6 +153,7 @@ class UserTestCase(APITestCase):
                 "city": None,
                 "avatar": None,
                 'payments': [],
+                'payments_total': {'count': 0, 'summ': 0},
                 "groups": [],
                 "user_permissions": []
             }
@@ -219,17 +264,21 @@ class PaymentTestCase(APITestCase):
         )
         self.assertEqual(
             response.json(),
-            [
-                {
-                    "id": self.payment.pk,
-                    "user": self.user.pk,
-                    "date": '2024-08-22T16:45:04Z',
-                    "course": self.course.pk,
-                    "lesson": None,
-                    "summ": 12990,
-                    "payment_method": 'cashless'
-                }
-            ]
+            {
+                "next": None,
+                "previous": None,
+                "results": [
+                    {
+                        "id": self.payment.pk,
+                        "user": self.user.pk,
+                        "date": '2024-08-22T16:45:04Z',
+                        "course": self.course.pk,
+                        "lesson": None,
+                        "summ": 12990,
+                        "payment_method": 'cashless'
+                    }
+                ]
+            }
         )
 
     def test_detail_payment(self):
@@ -293,3 +342,916 @@ class PaymentTestCase(APITestCase):
             response.status_code,
             status.HTTP_204_NO_CONTENT
         )
+
+
+class RolesTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.moderators = Group.objects.create(name='moderator')
+        self.user = User.objects.create(email='moderator@test.com')
+        self.user.groups.add(self.moderators)
+        course = Course.objects.create(name='Test course', description='Test description')
+        Lesson.objects.create(
+            name='test lesson',
+            description='test description',
+            video_link='https://www.youtube.com/test_video_link',
+            course=course
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def get_lessons(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/lesson/')
+        group_queries = [query for query in context.captured_queries if 'auth_group' in query['sql']]
+        return response, len(group_queries)
+
+    def test_roles_resolved_once_per_request(self):
+        """Роли пользователя вычисляются одним запросом для прав доступа и выборки"""
+        response, group_queries = self.get_lessons()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['count'], 1)
+        self.assertEqual(group_queries, 1)
+
+    @override_settings(USER_ROLES_CACHE_TIMEOUT=60)
+    def test_roles_cache_invalidation(self):
+        """Роли берутся из кэша и сбрасываются при изменении групп"""
+        self.assertEqual(self.get_lessons()[1], 1)
+        response, group_queries = self.get_lessons()
+        self.assertEqual(response.json()['count'], 1)
+        self.assertEqual(group_queries, 0)
+
+        self.user.groups.remove(self.moderators)
+        response, group_queries = self.get_lessons()
+        self.assertEqual(group_queries, 1)
+        self.assertEqual(response.json()['count'], 0)
+
+
+class CheckUserActivityTestCase(APITestCase):
+    def setUp(self):
+        long_ago = timezone.now() - datetime.timedelta(days=40)
+        recently = timezone.now() - datetime.timedelta(days=5)
+        self.stale_login = User.objects.create(email='stale@test.com', last_login=long_ago)
+        self.stale_joined = User.objects.create(email='joined@test.com')
+        User.objects.filter(pk=self.stale_joined.pk).update(date_joined=long_ago)
+        self.active_login = User.objects.create(email='active@test.com', last_login=recently)
+        self.new_user = User.objects.create(email='new@test.com')
+
+    def test_check_user_activity(self):
+        """Тестирование деактивации неактивных пользователей"""
+        result = check_user_activity(dry_run=True)
+        self.assertEqual(result['found'], 2)
+        self.assertEqual(User.objects.filter(is_active=False).count(), 0)
+
+        result = check_user_activity(batch_size=1)
+        self.assertEqual(result['deactivated'], 2)
+        self.assertEqual(
+            set(User.objects.filter(is_active=False).values_list('email', flat=True)),
+            {'stale@test.com', 'joined@test.com'}
+        )
+        self.assertEqual(check_user_activity()['deactivated'], 0)
+
+
+class StripePriceTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='buyer@test.ru')
+        self.course = Course.objects.create(name='Курс', description='Описание', user=self.user)
+        self.lesson = Lesson.objects.create(name='Урок', description='Описание', course=self.course, user=self.user)
+        self.client.force_authenticate(user=self.user)
+        clear_price_cache()
+        self.addCleanup(clear_price_cache)
+        self.stripe = FakeStripeServer().__enter__()
+        self.addCleanup(self.stripe.__exit__, None, None, None)
+
+    def buy(self, **data):
+        response = self.client.post('/payment/', data=data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.json()
+
+    def stripe_paths(self):
+        return [path for method, path, params in self.stripe.requests]
+
+    def test_price_reused(self):
+        """Продукт и цена создаются в stripe один раз, повторные покупки создают только сессию"""
+        first = self.buy(course=self.course.pk, summ=1000)
+        self.buy(course=self.course.pk, summ=1000)
+        clear_price_cache()
+        self.buy(course=self.course.pk, summ=1000)
+        self.assertEqual(
+            self.stripe_paths(),
+            ['/v1/products', '/v1/prices'] + ['/v1/checkout/sessions'] * 3
+        )
+        price = StripePrice.objects.get()
+        self.assertEqual(price.course, self.course)
+        self.assertEqual(self.stripe.requests[-1][2]['line_items[0][price]'], price.price_id)
+        self.assertEqual(first['session_id'], 'cs_test_3')
+
+    def test_new_amount_reuses_product(self):
+        """Для новой суммы создается только цена, продукт курса переиспользуется"""
+        self.buy(course=self.course.pk, summ=1000)
+        self.buy(course=self.course.pk, summ=2000)
+        self.buy(lesson=self.lesson.pk, summ=1000)
+        self.assertEqual(
+            self.stripe_paths(),
+            ['/v1/products', '/v1/prices', '/v1/checkout/sessions',
+             '/v1/prices', '/v1/checkout/sessions',
+             '/v1/products', '/v1/prices', '/v1/checkout/sessions']
+        )
+        course_prices = StripePrice.objects.filter(course=self.course)
+        self.assertEqual(course_prices.values('product_id').distinct().count(), 1)
+        self.assertEqual(self.stripe.requests[3][2]['unit_amount'], '200000')
+        self.assertTrue(StripePrice.objects.filter(lesson=self.lesson, amount=1000).exists())
+
+
+class PaymentCheckoutAsyncTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='buyer@test.ru')
+        self.course = Course.objects.create(name='Курс', description='Описание', user=self.user)
+        self.lesson = Lesson.objects.create(name='Урок', description='Описание', course=self.course, user=self.user)
+        self.client.force_authenticate(user=self.user)
+        clear_price_cache()
+        self.addCleanup(clear_price_cache)
+        self.stripe = FakeStripeServer().__enter__()
+        self.addCleanup(self.stripe.__exit__, None, None, None)
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', False)
+
+    def test_async_checkout(self):
+        """Платеж создается сразу в статусе pending, сессия stripe создается задачей после коммита"""
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post('/payment/', data={'course': self.course.pk, 'summ': 1000},
+                                        HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        data = response.json()
+        self.assertEqual(data['checkout_status'], Payment.CHECKOUT_PENDING)
+        self.assertIsNone(data['payment_link'])
+        self.assertEqual(response['Location'], data['status_url'])
+        self.assertEqual(self.stripe.requests, [])
+
+        status_url = reverse('materials:payment_status', args=(data['id'],))
+        self.assertEqual(self.client.get(status_url).json()['checkout_status'], Payment.CHECKOUT_PENDING)
+
+        for callback in callbacks:
+            callback()
+        payment = Payment.objects.get(pk=data['id'])
+        self.assertEqual(payment.checkout_status, Payment.CHECKOUT_CREATED)
+        self.assertIn(payment.session_id, self.stripe.sessions)
+        self.assertEqual(
+            self.client.get(status_url).json(),
+            {
+                'checkout_status': Payment.CHECKOUT_CREATED,
+                'payment_link': payment.payment_link,
+                'payment_status': 'unpaid',
+                'status': 'open'
+            }
+        )
+
+    @override_settings(PAYMENT_CHECKOUT_ASYNC=True)
+    def test_async_checkout_failed(self):
+        """Ошибка stripe переводит платеж в статус failed"""
+        error = stripe.InvalidRequestError('No such price', None)
+        with mock.patch('users.tasks.create_payment_checkout_session', side_effect=error), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/payment/', data={'lesson': self.lesson.pk, 'summ': 1000})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(Payment.objects.get(pk=response.json()['id']).checkout_status, Payment.CHECKOUT_FAILED)
+
+    @override_settings(PAYMENT_CHECKOUT_ASYNC=True, USER_PAYMENT_TOTALS_CACHE_TIMEOUT=3600)
+    def test_async_checkout_failed_totals(self):
+        """Неудавшийся в задаче платеж сразу пропадает из кэшированных итогов профиля"""
+        cache.clear()
+        error = stripe.InvalidRequestError('No such price', None)
+        with mock.patch('users.tasks.create_payment_checkout_session', side_effect=error), \
+                self.captureOnCommitCallbacks() as callbacks:
+            self.client.post('/payment/', data={'lesson': self.lesson.pk, 'summ': 1000})
+        self.assertEqual(load_payment_totals(self.user.pk), {'count': 1, 'summ': 1000})
+        with mock.patch('users.tasks.create_payment_checkout_session', side_effect=error):
+            for callback in callbacks:
+                callback()
+        self.assertEqual(load_payment_totals(self.user.pk), {'count': 0, 'summ': 0})
+
+    def test_sync_checkout(self):
+        """Без Prefer: respond-async сессия создается в запросе"""
+        response = self.client.post('/payment/', data={'course': self.course.pk, 'summ': 1000})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['checkout_status'], Payment.CHECKOUT_CREATED)
+
+    def test_sync_checkout_failed(self):
+        """Ошибка stripe в запросе помечает платеж failed и возвращает 503"""
+        errors = (stripe.InvalidRequestError('No such price', None), StripeUnavailable(wait=30))
+        for error in errors:
+            with mock.patch('users.views.create_payment_checkout_session', side_effect=error):
+                response = self.client.post('/payment/', data={'course': self.course.pk, 'summ': 1000})
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(
+            list(Payment.objects.values_list('checkout_status', flat=True)),
+            [Payment.CHECKOUT_FAILED, Payment.CHECKOUT_FAILED]
+        )
+        cache.clear()
+        self.assertEqual(load_payment_totals(self.user.pk), {'count': 0, 'summ': 0})
+
+    def test_validate_course_or_lesson(self):
+        """Нужно выбрать ровно один курс или урок, иначе платеж не создается"""
+        for data in ({'summ': 1000}, {'course': self.course.pk, 'lesson': self.lesson.pk, 'summ': 1000}):
+            response = self.client.post('/payment/', data=data, HTTP_PREFER='respond-async')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Payment.objects.exists())
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test', PAYMENT_STATUS_STALE_AFTER=60)
+class PaymentWebhookTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='buyer@test.ru')
+        self.course = Course.objects.create(name='Курс', description='Описание', user=self.user)
+        self.client.force_authenticate(user=self.user)
+        clear_price_cache()
+        self.addCleanup(clear_price_cache)
+        self.stripe = FakeStripeServer().__enter__()
+        self.addCleanup(self.stripe.__exit__, None, None, None)
+        response = self.client.post('/payment/', data={'course': self.course.pk, 'summ': 1000})
+        self.payment = Payment.objects.get(pk=response.json()['id'])
+        self.status_url = reverse('materials:payment_status', args=(self.payment.pk,))
+        self.webhook_url = reverse('materials:payment_webhook')
+
+    def send_webhook(self, payload, secret='whsec_test'):
+        self.client.logout()
+        return self.client.post(self.webhook_url, data=payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=sign_webhook_payload(payload, secret))
+
+    def session_retrievals(self):
+        return [path for method, path, params in self.stripe.requests if method == 'GET']
+
+    def test_status_from_db(self):
+        """Свежий статус отдается из БД без запроса в stripe"""
+        for _ in range(3):
+            response = self.client.get(self.status_url)
+            self.assertEqual(response.json()['status'], 'open')
+        self.assertEqual(self.session_retrievals(), [])
+
+    def test_status_scope(self):
+        """Статус платежа доступен только владельцу и модератору"""
+        Payment.objects.filter(pk=self.payment.pk).update(
+            status_updated_at=timezone.now() - datetime.timedelta(minutes=5)
+        )
+        self.client.logout()
+        self.assertEqual(self.client.get(self.status_url).status_code, status.HTTP_401_UNAUTHORIZED)
+        other = User.objects.create(email='other@test.ru')
+        self.client.force_authenticate(user=other)
+        self.assertEqual(self.client.get(self.status_url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.session_retrievals(), [])
+        other.groups.add(Group.objects.create(name='moderator'))
+        self.assertEqual(self.client.get(self.status_url).status_code, status.HTTP_200_OK)
+
+    def test_webhook_updates_status(self):
+        """Подписанный вебхук обновляет статус платежа"""
+        session = self.stripe.complete_session(self.payment.session_id)
+        response = self.send_webhook(make_webhook_event('checkout.session.completed', session))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'updated': 1})
+
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(
+            self.client.get(self.status_url).json(),
+            {
+                'checkout_status': Payment.CHECKOUT_CREATED,
+                'payment_link': self.payment.payment_link,
+                'payment_status': 'paid',
+                'status': 'complete'
+            }
+        )
+        self.assertEqual(self.session_retrievals(), [])
+
+    def test_webhook_bad_signature(self):
+        """Вебхук с неверной подписью отклоняется"""
+        session = self.stripe.complete_session(self.payment.session_id)
+        response = self.send_webhook(make_webhook_event('checkout.session.completed', session), secret='whsec_other')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.session_status, 'open')
+
+    @override_settings(STRIPE_WEBHOOK_SECRET=None)
+    def test_webhook_secret_missing(self):
+        """Без настроенного секрета вебхук не обрабатывается и возвращается 503"""
+        session = self.stripe.complete_session(self.payment.session_id)
+        response = self.send_webhook(make_webhook_event('checkout.session.completed', session))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.session_status, 'open')
+
+    def test_old_event_ignored(self):
+        """Событие старее сохраненного статуса не перезаписывает его"""
+        session = dict(self.stripe.sessions[self.payment.session_id], payment_status='unpaid', status='open')
+        created = int(self.payment.status_updated_at.timestamp()) - 60
+        response = self.send_webhook(make_webhook_event('checkout.session.async_payment_failed', session, created))
+        self.assertEqual(response.json(), {'updated': 0})
+
+    def test_stale_status_fallback(self):
+        """Устаревший статус перепроверяется в stripe один раз и сохраняется"""
+        Payment.objects.filter(pk=self.payment.pk).update(
+            status_updated_at=timezone.now() - datetime.timedelta(minutes=5)
+        )
+        self.stripe.complete_session(self.payment.session_id)
+        for _ in range(2):
+            response = self.client.get(self.status_url)
+            self.assertEqual(response.json()['payment_status'], 'paid')
+        self.assertEqual(self.session_retrievals(), [f'/v1/checkout/sessions/{self.payment.session_id}'])
+
+    def test_stale_status_stripe_error(self):
+        """Постоянная ошибка stripe при перепроверке статуса не ломает ответ, отдается статус из БД"""
+        Payment.objects.filter(pk=self.payment.pk).update(
+            status_updated_at=timezone.now() - datetime.timedelta(minutes=5)
+        )
+        for error in (stripe.InvalidRequestError('No such checkout.session', None), stripe.AuthenticationError()):
+            with mock.patch('stripe.checkout.Session.retrieve', side_effect=error):
+                response = self.client.get(self.status_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual((response.json()['payment_status'], response.json()['status']), ('unpaid', 'open'))
+
+
+class PooledRequestsClientTestCase(APITestCase):
+    def setUp(self):
+        self.stripe = FakeStripeServer().__enter__()
+        self.addCleanup(self.stripe.__exit__, None, None, None)
+        self.client_http = PooledRequestsClient(connect_timeout=1, read_timeout=2, pool_size=2)
+        self.addCleanup(self.client_http.close)
+        self.addCleanup(setattr, stripe, 'default_http_client', stripe.default_http_client)
+        stripe.default_http_client = self.client_http
+        self.session_id = stripe.checkout.Session.create(line_items=[], mode='payment').get('id')
+
+    def retrieve(self):
+        return stripe.checkout.Session.retrieve(self.session_id)
+
+    def test_connection_reused(self):
+        """Запросы одного процесса идут через одно keep-alive соединение"""
+        for _ in range(3):
+            self.assertEqual(self.retrieve().get('status'), 'open')
+        self.assertEqual(self.stripe.connections, 1)
+        self.assertEqual(self.client_http.stats['requests'], 4)
+        self.assertEqual(self.client_http._timeout, (1, 2))
+
+    def test_new_pool_after_fork(self):
+        """После fork дочерний процесс не использует соединения родителя"""
+        session = self.client_http.get_session()
+        self.client_http.pid = -1
+        self.assertIsNot(self.client_http.get_session(), session)
+        self.retrieve()
+        self.assertEqual(self.stripe.connections, 2)
+
+
+@override_settings(STRIPE_BREAKER_WINDOW=60, STRIPE_BREAKER_MIN_CALLS=2, STRIPE_BREAKER_FAILURE_RATE=0.5,
+                   STRIPE_BREAKER_RECOVERY_TIMEOUT=30, STRIPE_BREAKER_SLOW_CALL=5)
+class CircuitBreakerTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.breaker = CircuitBreaker('test')
+        self.calls = 0
+        self.user = User.objects.create(email='buyer@test.ru')
+        self.course = Course.objects.create(name='Курс', description='Описание', user=self.user)
+        self.client.force_authenticate(user=self.user)
+
+    def call(self, error=None):
+        @self.breaker
+        def stripe_call():
+            self.calls += 1
+            if error:
+                raise error
+            return 'ok'
+        return stripe_call()
+
+    def open_breaker(self, breaker, seconds_ago=0):
+        cache.set(breaker.key('opened_at'), time.time() - seconds_ago, None)
+
+    def test_opens_after_failures(self):
+        """После доли ошибок выше порога вызовы завершаются сразу, без обращения к сервису"""
+        with self.assertRaises(stripe.APIConnectionError):
+            self.call(stripe.APIConnectionError('down'))
+        self.assertEqual(self.call(), 'ok')
+        with self.assertRaises(stripe.APIConnectionError):
+            self.call(stripe.APIConnectionError('down'))
+        with self.assertRaises(StripeUnavailable) as context:
+            self.call()
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(context.exception.wait, 30)
+        metrics = self.breaker.get_metrics()
+        self.assertEqual(metrics['state'], CircuitBreaker.OPEN)
+        self.assertEqual(metrics['rejected'], 1)
+        self.assertEqual(metrics['transitions']['closed->open'], 1)
+
+    def test_client_errors_ignored(self):
+        """Ошибки запроса клиента не размыкают цепь"""
+        for _ in range(3):
+            with self.assertRaises(stripe.InvalidRequestError):
+                self.call(stripe.InvalidRequestError('No such price', None))
+        self.assertEqual(self.breaker.get_state(), CircuitBreaker.CLOSED)
+
+    @override_settings(STRIPE_BREAKER_SLOW_CALL=-1)
+    def test_slow_calls(self):
+        """Медленные вызовы считаются ошибками"""
+        self.call()
+        self.call()
+        self.assertEqual(self.breaker.get_state(), CircuitBreaker.OPEN)
+
+    def test_half_open_probe(self):
+        """После recovery_timeout проходит один пробный вызов, успешный замыкает цепь"""
+        self.open_breaker(self.breaker, seconds_ago=31)
+        self.assertEqual(self.breaker.get_state(), CircuitBreaker.HALF_OPEN)
+        self.assertEqual(self.call(), 'ok')
+        self.assertEqual(self.breaker.get_state(), CircuitBreaker.CLOSED)
+
+        self.open_breaker(self.breaker, seconds_ago=31)
+        with self.assertRaises(stripe.APIError):
+            self.call(stripe.APIError('Internal error'))
+        self.assertEqual(self.breaker.get_state(), CircuitBreaker.OPEN)
+        self.assertEqual(
+            self.breaker.get_metrics()['transitions'],
+            {'closed->open': 0, 'open->half_open': 2, 'half_open->open': 1, 'half_open->closed': 1}
+        )
+
+    def test_payment_fails_fast(self):
+        """При разомкнутой цепи платеж не создается, API отвечает 503 с Retry-After"""
+        self.open_breaker(stripe_breaker)
+        response = self.client.post('/payment/', data={'course': self.course.pk, 'summ': 1000})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertFalse(Payment.objects.exists())
+
+    def test_status_from_db_while_open(self):
+        """При разомкнутой цепи статус платежа отдается из БД"""
+        payment = Payment.objects.create(
+            user=self.user, course=self.course, summ=1000, session_id='cs_test_1',
+            checkout_status=Payment.CHECKOUT_CREATED, payment_status='unpaid', session_status='open'
+        )
+        self.open_breaker(stripe_breaker)
+        response = self.client.get(reverse('materials:payment_status', args=(payment.pk,)))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['status'], 'open')
+
+    def test_metrics_for_moderators(self):
+        """Метрики размыкателя доступны только модераторам"""
+        url = reverse('materials:payment_circuit')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+        moderators = Group.objects.create(name='moderator')
+        self.user.groups.add(moderators)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['state'], CircuitBreaker.CLOSED)
+
+
+class PaymentIdempotencyTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        clear_price_cache()
+        self.addCleanup(clear_price_cache)
+        self.user = User.objects.create(email='buyer@test.ru')
+        self.course = Course.objects.create(name='Курс', description='Описание', user=self.user)
+        self.client.force_authenticate(user=self.user)
+        self.stripe = FakeStripeServer().__enter__()
+        self.addCleanup(self.stripe.__exit__, None, None, None)
+
+    def buy(self, key='key-1', summ=1000, **headers):
+        return self.client.post('/payment/', data={'course': self.course.pk, 'summ': summ},
+                                HTTP_IDEMPOTENCY_KEY=key, **headers)
+
+    def sessions_created(self):
+        return [path for method, path, params in self.stripe.requests if path == '/v1/checkout/sessions']
+
+    def test_response_replayed(self):
+        """Повтор с тем же ключом возвращает сохраненный ответ без нового платежа и сессии stripe"""
+        first = self.buy()
+        second = self.buy()
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(len(self.sessions_created()), 1)
+        self.assertEqual(self.stripe.idempotency_keys, [f'payment-session-{self.user.pk}-key-1'])
+
+        self.buy(key='key-2')
+        self.assertEqual(Payment.objects.count(), 2)
+
+    def test_async_response_replayed(self):
+        """Ответ 202 повторяется вместе с заголовком Location"""
+        with self.captureOnCommitCallbacks():
+            first = self.buy(HTTP_PREFER='respond-async')
+            second = self.buy(HTTP_PREFER='respond-async')
+        self.assertEqual(second.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(second['Location'], first['Location'])
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_other_body(self):
+        """Тот же ключ с другими параметрами запроса отклоняется"""
+        self.buy()
+        response = self.buy(summ=2000)
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_concurrent_request(self):
+        """Пока первый запрос обрабатывается, повтор получает 409 и ничего не создает"""
+        cache.add(f'{get_idempotency_cache_key(self.user.pk, "key-1")}:lock', 1)
+        response = self.buy()
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(Payment.objects.exists())
+        self.assertEqual(self.stripe.requests, [])
+
+    def test_lost_cached_response(self):
+        """Если ответ пропал из кеша, платеж находится по ключу в БД"""
+        first = self.buy()
+        cache.clear()
+        second = self.buy()
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.json()['id'], first.json()['id'])
+        self.assertEqual(len(self.sessions_created()), 1)
+
+    def test_failed_payment_completed(self):
+        """Повтор после сбоя stripe достраивает сессию для уже созданного платежа, stripe получает тот же ключ"""
+        with mock.patch('users.services.create_session', side_effect=stripe.APIError('Internal error')):
+            self.assertEqual(self.buy().status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        payment = Payment.objects.get()
+        self.assertEqual(payment.checkout_status, Payment.CHECKOUT_FAILED)
+
+        response = self.buy()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['id'], payment.pk)
+        self.assertEqual(response.json()['checkout_status'], Payment.CHECKOUT_CREATED)
+        self.assertEqual(self.stripe.idempotency_keys, [f'payment-session-{self.user.pk}-key-1'])
+
+
+@override_settings(PAYMENT_RECONCILE_PAGE_SIZE=3)
+class ReconcilePendingPaymentsTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.stripe = FakeStripeServer().__enter__()
+        self.addCleanup(self.stripe.__exit__, None, None, None)
+        self.user = User.objects.create(email='buyer@test.ru')
+        self.course = Course.objects.create(name='Курс', description='Описание', user=self.user)
+        self.payments = []
+        for _ in range(7):
+            session = stripe.checkout.Session.create(line_items=[], mode='payment')
+            self.payments.append(Payment.objects.create(
+                user=self.user, course=self.course, summ=1000, date=timezone.now(), session_id=session.id,
+                checkout_status=Payment.CHECKOUT_CREATED, payment_status='unpaid', session_status='open'
+            ))
+        # Сессия, не относящаяся к платежам, и уже завершенный платеж, который сверять не нужно
+        stripe.checkout.Session.create(line_items=[], mode='payment')
+        Payment.objects.filter(pk=self.payments[0].pk).update(payment_status='paid', session_status='complete')
+        self.stripe.requests.clear()
+
+    def test_reconcile(self):
+        """Статусы открытых платежей обновляются по страницам списка сессий, без запроса на каждый платеж"""
+        for payment in self.payments[1:3]:
+            self.stripe.complete_session(payment.session_id)
+        with CaptureQueriesContext(connection) as queries:
+            result = reconcile_pending_payments()
+        self.assertEqual(result['pending'], 6)
+        self.assertEqual(result['updated'], 2)
+        self.assertEqual(result['pages'], 3)
+        # Выборка открытых платежей, блокировка изменившихся и один UPDATE (плюс точка сохранения транзакции)
+        self.assertEqual(len([query for query in queries if 'SAVEPOINT' not in query['sql']]), 3)
+        self.assertEqual({path for method, path, params in self.stripe.requests}, {'/v1/checkout/sessions'})
+        self.assertEqual(self.stripe.requests[0][2]['limit'], '3')
+        self.assertEqual(
+            set(Payment.objects.filter(session_status='complete').values_list('pk', flat=True)),
+            {payment.pk for payment in self.payments[:3]}
+        )
+
+    def test_newer_status_kept(self):
+        """Статус, сохраненный вебхуком во время сверки, не перезаписывается данными со страницы stripe"""
+        payment = self.payments[1]
+        Payment.objects.filter(pk=payment.pk).update(payment_status=None, session_status=None)
+
+        def pages_with_webhook(*args, **kwargs):
+            for sessions in iter_checkout_session_pages(*args, **kwargs):
+                update_payment_status(payment.session_id, 'paid', 'complete', timezone.now())
+                yield sessions
+
+        with mock.patch('users.tasks.iter_checkout_session_pages', side_effect=pages_with_webhook):
+            result = reconcile_pending_payments()
+        self.assertEqual(result['updated'], 0)
+        payment.refresh_from_db()
+        self.assertEqual((payment.payment_status, payment.session_status), ('paid', 'complete'))
+
+    def test_stops_when_all_found(self):
+        """Сверка не листает страницы дальше, когда все открытые платежи найдены"""
+        Payment.objects.filter(pk__in=[payment.pk for payment in self.payments[1:5]]).update(session_status='expired')
+        result = reconcile_pending_payments()
+        self.assertEqual(result['pending'], 2)
+        self.assertEqual(result['pages'], 1)
+        self.assertEqual(result['updated'], 0)
+
+
+class PaymentListTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(email='buyer@test.ru')
+        self.other = User.objects.create(email='other@test.ru')
+        self.course = Course.objects.create(name='Курс', description='Описание', user=self.user)
+        for user in (self.user, self.other):
+            Payment.objects.bulk_create(
+                Payment(user=user, course=self.course, summ=1000 + i, date=timezone.now(), payment_method='card')
+                for i in range(25)
+            )
+        self.client.force_authenticate(user=self.user)
+
+    def test_scoped_pages(self):
+        """Пользователь видит только свои платежи, постранично по курсору"""
+        response = self.client.get('/payment/')
+        data = response.json()
+        self.assertEqual(len(data['results']), 20)
+        self.assertTrue(all(payment['user'] == self.user.pk for payment in data['results']))
+        ids = [payment['id'] for payment in data['results']]
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
+        next_page = self.client.get(data['next']).json()
+        self.assertEqual(len(next_page['results']), 5)
+        self.assertIsNone(next_page['next'])
+
+    def test_moderator_sees_all(self):
+        """Модератор видит платежи всех пользователей"""
+        self.user.groups.add(Group.objects.create(name='moderator'))
+        response = self.client.get('/payment/', {'page_size': 100})
+        self.assertEqual(len(response.json()['results']), 50)
+
+    def test_other_user_payment_hidden(self):
+        """Чужой платеж недоступен по ссылке"""
+        payment = Payment.objects.filter(user=self.other).first()
+        response = self.client.get(reverse('materials:payment-detail', args=(payment.pk,)))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_query_count(self):
+        """Число запросов к БД не зависит от размера страницы"""
+        with CaptureQueriesContext(connection) as small:
+            self.client.get('/payment/', {'page_size': 2, 'ordering': '-date'})
+        with CaptureQueriesContext(connection) as large:
+            self.client.get('/payment/', {'page_size': 25, 'ordering': '-date'})
+        self.assertEqual(len(small), len(large))
+
+
+@override_settings(PAYMENT_EXPORT_CHUNK_SIZE=4)
+class PaymentExportTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(email='buyer@test.ru')
+        self.other = User.objects.create(email='other@test.ru')
+        self.course = Course.objects.create(name='Курс', description='Описание', user=self.user)
+        self.lesson = Lesson.objects.create(name='Урок', description='Описание', course=self.course, user=self.user)
+        date = datetime.datetime(2024, 8, 1, tzinfo=datetime.timezone.utc)
+        Payment.objects.bulk_create(
+            Payment(user=self.user, course=self.course if i % 2 else None, lesson=None if i % 2 else self.lesson,
+                    summ=1000 + i, date=date + datetime.timedelta(days=i), payment_method='card')
+            for i in range(10)
+        )
+        Payment.objects.create(user=self.other, course=self.course, summ=1, date=date, payment_method='cash')
+        self.client.force_authenticate(user=self.user)
+
+    def export(self, **params):
+        response = self.client.get(reverse('materials:payment-export'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_csv(self):
+        """Выгрузка в csv содержит поля PaymentSerializer и только свои платежи"""
+        response, content = self.export()
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        rows = list(csv.DictReader(io.StringIO(content)))
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(set(rows[0]), set(PaymentSerializer().fields))
+        self.assertEqual(rows[0]['summ'], '1009')
+        self.assertEqual(rows[0]['user'], str(self.user.pk))
+
+    def test_ndjson_filters(self):
+        """Выгрузка в ndjson поддерживает фильтры списка платежей"""
+        response, content = self.export(export_format='ndjson', course=self.course.pk,
+                                        date_after='2024-08-03T00:00:00Z', date_before='2024-08-09T00:00:00Z')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['summ'] for row in rows], [1007, 1005, 1003])
+        self.assertEqual(rows[0]['date'], '2024-08-08T05:00:00+05:00')
+
+    def test_single_query(self):
+        """Платежи читаются одним запросом через серверный курсор"""
+        with CaptureQueriesContext(connection) as queries:
+            self.export()
+        self.assertEqual(len([query for query in queries if 'users_payment' in query['sql']]), 1)
+
+    def test_wrong_format(self):
+        """Неизвестный формат выгрузки отклоняется"""
+        response = self.client.get(reverse('materials:payment-export'), {'export_format': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_command(self):
+        """Команда выгружает все платежи с фильтрами"""
+        output = io.StringIO()
+        call_command('export_payments', format='ndjson', payment_method='cash', stdout=output)
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([row['user'] for row in rows], [self.other.pk])
+
+
+@override_settings(USER_RECENT_PAYMENTS=3, USER_PAYMENT_TOTALS_CACHE_TIMEOUT=3600)
+class UserPaymentHistoryTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(email='buyer@test.ru')
+        self.other = User.objects.create(email='other@test.ru')
+        self.course = Course.objects.create(name='Курс', description='Описание', user=self.user)
+        self.payments = [
+            Payment.objects.create(user=self.user, course=self.course, summ=100 * (i + 1), date=timezone.now())
+            for i in range(5)
+        ]
+        Payment.objects.create(user=self.other, course=self.course, summ=1, date=timezone.now())
+        self.client.force_authenticate(user=self.user)
+
+    def get_profile(self):
+        return self.client.get(reverse('users:view_user', args=(self.user.pk,))).json()
+
+    def test_recent_payments(self):
+        """В профиле только последние платежи и итоги по всем платежам"""
+        data = self.get_profile()
+        self.assertEqual([payment['id'] for payment in data['payments']],
+                         [payment.pk for payment in self.payments[:1:-1]])
+        self.assertEqual(data['payments_total'], {'count': 5, 'summ': 1500})
+
+    def test_query_count(self):
+        """Платежи загружаются одним запросом, итоги берутся из кэша"""
+        self.get_profile()
+        Payment.objects.bulk_create(
+            Payment(user=self.user, course=self.course, summ=1, date=timezone.now()) for _ in range(20)
+        )
+        with CaptureQueriesContext(connection) as queries:
+            data = self.get_profile()
+        payment_queries = [query['sql'] for query in queries if 'users_payment' in query['sql']]
+        self.assertEqual(len(payment_queries), 1)
+        self.assertEqual(len(data['payments']), 3)
+        self.assertEqual(data['payments_total']['count'], 5)
+
+    @override_settings(USER_PAYMENT_TOTALS_CACHE_TIMEOUT=0)
+    def test_totals_without_shared_cache(self):
+        """Без общего кэша итоги считаются при каждом запросе"""
+        self.get_profile()
+        Payment.objects.bulk_create(
+            Payment(user=self.user, course=self.course, summ=1, date=timezone.now()) for _ in range(2)
+        )
+        self.assertEqual(self.get_profile()['payments_total'], {'count': 7, 'summ': 1502})
+
+    def test_totals_invalidated(self):
+        """Итоги пересчитываются после создания и удаления платежа"""
+        self.get_profile()
+        Payment.objects.create(user=self.user, course=self.course, summ=500, date=timezone.now())
+        self.assertEqual(self.get_profile()['payments_total'], {'count': 6, 'summ': 2000})
+        self.payments[0].delete()
+        self.assertEqual(self.get_profile()['payments_total'], {'count': 5, 'summ': 1900})
+
+    def test_payment_history(self):
+        """Полная история платежей доступна постранично владельцу и модератору"""
+        url = reverse('users:user_payments', args=(self.user.pk,))
+        data = self.client.get(url, {'page_size': 2}).json()
+        self.assertEqual([payment['id'] for payment in data['results']], [self.payments[4].pk, self.payments[3].pk])
+        self.assertEqual(len(self.client.get(data['next']).json()['results']), 2)
+
+        other_url = reverse('users:user_payments', args=(self.other.pk,))
+        self.assertEqual(self.client.get(other_url).status_code, status.HTTP_403_FORBIDDEN)
+        self.user.groups.add(Group.objects.create(name='moderator'))
+        self.assertEqual(len(self.client.get(other_url).json()['results']), 1)
+
+
+@override_settings(USER_AUTH_CACHE_TIMEOUT=300)
+class CachedJWTAuthenticationTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        clear_local_user_auth()
+        self.addCleanup(clear_local_user_auth)
+        self.user = User.objects.create(email='buyer@test.ru', last_login=timezone.now())
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def user_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/payment/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len([query for query in queries if query['sql'].startswith('SELECT') and 'FROM "users_user" WHERE' in query['sql']])
+
+    def test_user_cached(self):
+        """Пользователь загружается из БД только при первом запросе"""
+        self.assertEqual(self.user_queries(), 1)
+        self.assertEqual(self.user_queries(), 0)
+
+    @override_settings(USER_AUTH_LOCAL_CACHE_TIMEOUT=0)
+    def test_shared_cache(self):
+        """Без кэша процесса пользователь берется из общего кэша"""
+        self.user_queries()
+        self.assertEqual(self.user_queries(), 0)
+
+    @override_settings(USER_AUTH_CACHE_TIMEOUT=0)
+    def test_without_shared_cache(self):
+        """Без общего кэша пользователь загружается из БД при каждом запросе"""
+        self.assertEqual(self.user_queries(), 1)
+        self.assertEqual(self.user_queries(), 1)
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.client.get('/payment/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_save_invalidates(self):
+        """Сохранение пользователя сбрасывает кэш"""
+        self.user_queries()
+        self.user.city = 'Пермь'
+        self.user.save()
+        self.assertEqual(self.user_queries(), 1)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/payment/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivation_invalidates(self):
+        """Деактивация в check_user_activity сбрасывает кэш"""
+        self.user_queries()
+        User.objects.filter(pk=self.user.pk).update(last_login=timezone.now() - datetime.timedelta(days=60))
+        self.assertEqual(check_user_activity()['deactivated'], 1)
+        self.assertEqual(self.client.get('/payment/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(LAST_LOGIN_BUFFERED=True)
+class LastLoginBufferTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(email='login@test.ru')
+        self.user.set_password('password')
+        self.user.save()
+
+    def test_login_without_update(self):
+        """Вход не обновляет last_login в БД, время сохраняется задачей flush_last_logins"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/users/login/', {'email': 'login@test.ru', 'password': 'password'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('access', response.json())
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE')])
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.last_login)
+
+        result = flush_last_logins()
+        self.assertEqual((result['entries'], result['users'], result['updated']), (1, 1, 1))
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_login)
+        self.assertEqual(flush_last_logins()['entries'], 0)
+
+    @override_settings(LAST_LOGIN_BUFFERED=False)
+    def test_login_without_buffer(self):
+        """Без общего кэша last_login сохраняется в БД сразу при входе"""
+        response = self.client.post('/users/login/', {'email': 'login@test.ru', 'password': 'password'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_login)
+        self.assertEqual(flush_last_logins()['entries'], 0)
+
+    def test_flush_keeps_latest(self):
+        """Из нескольких входов сохраняется самый поздний, last_login не сдвигается назад"""
+        now = timezone.now()
+        other = User.objects.create(email='other@test.ru', last_login=now)
+        record_last_login(self.user.pk, now - datetime.timedelta(hours=1))
+        record_last_login(self.user.pk, now)
+        record_last_login(other.pk, now - datetime.timedelta(days=1))
+        with self.assertNumQueries(1):
+            result = flush_last_logins()
+        self.assertEqual((result['entries'], result['users'], result['updated']), (3, 2, 1))
+        self.user.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(self.user.last_login, now)
+        self.assertEqual(other.last_login, now)
+
+    def test_missing_entry_retried(self):
+        """Номер без записи проверяется при следующем сбросе еще раз"""
+        cache.add(LAST_LOGIN_SEQUENCE_KEY, 0, None)
+        cache.incr(LAST_LOGIN_SEQUENCE_KEY)
+        self.assertEqual(flush_last_logins()['missing'], 1)
+        cache.set('last_login:entry:1', (self.user.pk, timezone.now()))
+        result = flush_last_logins()
+        self.assertEqual((result['entries'], result['missing']), (1, 0))
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_login)
+
+    def test_check_user_activity_flushes(self):
+        """Перед поиском неактивных пользователей отложенные входы сохраняются в БД"""
+        User.objects.filter(pk=self.user.pk).update(last_login=timezone.now() - datetime.timedelta(days=60))
+        record_last_login(self.user.pk)
+        self.assertEqual(check_user_activity()['deactivated'], 0)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.is_active)
+
+    def test_flush_waits_for_lock(self):
+        """Сброс ждет окончания сброса в другом процессе"""
+        record_last_login(self.user.pk)
+        cache.add(LAST_LOGIN_LOCK_KEY, 1)
+        self.assertIsNone(flush_last_login_buffer())
+        timer = threading.Timer(0.2, cache.delete, [LAST_LOGIN_LOCK_KEY])
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual(flush_last_login_buffer(wait=5)['updated'], 1)
+
+    @mock.patch('materials.tasks.USER_ACTIVITY_FLUSH_WAIT', 0)
+    def test_check_user_activity_skipped(self):
+        """Если сброс входов идет в другом процессе и не закончился, проверка активности пропускается"""
+        User.objects.filter(pk=self.user.pk).update(last_login=timezone.now() - datetime.timedelta(days=60))
+        record_last_login(self.user.pk)
+        cache.add(LAST_LOGIN_LOCK_KEY, 1)
+        result = check_user_activity()
+        self.assertTrue(result['skipped'])
+        self.assertEqual(result['deactivated'], 0)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.is_active)
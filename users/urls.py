@@ -2,7 +2,8 @@ from django.urls import path
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 from users.apps import UsersConfig
-from users.views import UserCreateAPIView, UserListAPIView, UserRetrieveAPIView, UserUpdateAPIView, UserDestroyAPIView
+from users.views import UserCreateAPIView, UserListAPIView, UserRetrieveAPIView, UserUpdateAPIView, UserDestroyAPIView, \
+    UserPaymentListAPIView
 
 app_name = UsersConfig.name
 
@@ -13,6 +14,7 @@ urlpatterns = [
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('', UserListAPIView.as_view(), name='users'),
     path('view/<int:pk>/', UserRetrieveAPIView.as_view(), name='view_user'),
+    path('<int:pk>/payments/', UserPaymentListAPIView.as_view(), name='user_payments'),
     path('update/<int:pk>/', UserUpdateAPIView.as_view(), name='update_user'),
     path('delete/<int:pk>/', UserDestroyAPIView.as_view(), name='delete_user'),
 ]
@@ -1,17 +1,44 @@
-import datetime
+import hashlib
+import json
+import logging
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import viewsets, generics
-from rest_framework.exceptions import ValidationError
-from rest_framework.filters import OrderingFilter
-from rest_framework.permissions import IsAuthenticated
+from rest_framework import viewsets, generics, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.filters import OrderingFilter, SearchFilter
+from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from rest_framework.views import APIView
+import stripe
 
+from users.exports import export_payments, EXPORT_CONTENT_TYPES
+from users.filters import PaymentFilter
 from users.models import User, Payment
-from users.permissions import IsSelfUser
+from users.paginators import PaymentPaginator, UserPaginator
+from users.permissions import IsSelfUser, IsModerator
+from users.roles import is_moderator
 from users.serializes import SelfUserSerializer, AnotherUserSerializer, PaymentSerializer, UserRegisterSerializer
-from users.services import create_product, create_price, create_session, get_payment_status
+from users.services import create_payment_checkout_session, refresh_payment_status, handle_stripe_event, \
+    stripe_breaker, get_idempotency_cache_key, StripeUnavailable
+from users.tasks import create_payment_checkout
+
+logger = logging.getLogger(__name__)
+
+
+def get_scoped_payments(request):
+    """Возвращает платежи, доступные текущему пользователю: модератору все, остальным только свои"""
+    if is_moderator(request):
+        return Payment.objects.all()
+    return Payment.objects.filter(user=request.user)
 
 
 # Create your views here.
@@ -28,11 +55,22 @@ class UserListAPIView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = AnotherUserSerializer
     queryset = User.objects.all()
+    pagination_class = UserPaginator
+    filter_backends = [DjangoFilterBackend, SearchFilter]
+    filterset_fields = ('email', 'city', 'phone')
+    search_fields = ('email', 'city')
 
 
 class UserRetrieveAPIView(generics.RetrieveAPIView):
     permission_classes = [IsAuthenticated]
-    queryset = User.objects.all()
+
+    def get_queryset(self):
+        if self.request.user.pk == self.kwargs['pk']:
+            recent_payments = Payment.objects.order_by('-id')[:settings.USER_RECENT_PAYMENTS]
+            return User.objects.prefetch_related(
+                Prefetch('payment_set', queryset=recent_payments, to_attr='recent_payments')
+            )
+        return User.objects.all()
 
     def get_serializer_class(self):
         if self.request.user.pk == self.kwargs['pk']:
@@ -40,6 +78,21 @@ class UserRetrieveAPIView(generics.RetrieveAPIView):
         return AnotherUserSerializer
 
 
+class UserPaymentListAPIView(generics.ListAPIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = PaymentSerializer
+    pagination_class = PaymentPaginator
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    filterset_class = PaymentFilter
+    ordering_fields = ('id', 'date')
+    ordering = ('-id',)
+
+    def get_queryset(self):
+        if self.request.user.pk != self.kwargs['pk'] and not is_moderator(self.request):
+            raise PermissionDenied('Можно просматривать только свои платежи')
+        return Payment.objects.filter(user_id=self.kwargs['pk'])
+
+
 class UserUpdateAPIView(generics.UpdateAPIView):
     permission_classes = [IsAuthenticated, IsSelfUser]
     serializer_class = SelfUserSerializer
@@ -54,37 +107,157 @@ class UserDestroyAPIView(generics.DestroyAPIView):
 class PaymentViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     serializer_class = PaymentSerializer
-    queryset = Payment.objects.all()
+    pagination_class = PaymentPaginator
     filter_backends = [DjangoFilterBackend, OrderingFilter]
-    filterset_fields = ('course', 'lesson', 'payment_method')
-    ordering_fields = ('date',)
+    filterset_class = PaymentFilter
+    ordering_fields = ('id', 'date')
+    ordering = ('-id',)
+
+    def get_queryset(self):
+        # Курс и урок сериализуются первичными ключами из course_id и lesson_id, select_related не нужен
+        return get_scoped_payments(self.request)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request, *args, **kwargs):
+        """Потоковая выгрузка платежей в csv или ndjson с теми же фильтрами, что и список"""
+        export_format = request.query_params.get('export_format', 'csv')
+        if export_format not in EXPORT_CONTENT_TYPES:
+            return Response({'export_format': f'Допустимые форматы: {", ".join(EXPORT_CONTENT_TYPES)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        queryset = self.filter_queryset(self.get_queryset())
+        response = StreamingHttpResponse(
+            export_payments(queryset, export_format, settings.PAYMENT_EXPORT_CHUNK_SIZE),
+            content_type=EXPORT_CONTENT_TYPES[export_format]
+        )
+        response['Content-Disposition'] = f'attachment; filename="payments.{export_format}"'
+        return response
+
+    def is_async_checkout(self):
+        """Сессия оплаты создается в фоне, если так настроено или клиент прислал Prefer: respond-async"""
+        return settings.PAYMENT_CHECKOUT_ASYNC or 'respond-async' in self.request.headers.get('Prefer', '')
+
+    def create(self, request, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return self.create_payment(request, *args, **kwargs)
+        if len(key) > Payment._meta.get_field('idempotency_key').max_length:
+            return Response({'detail': 'Слишком длинный Idempotency-Key'}, status=status.HTTP_400_BAD_REQUEST)
+
+        cache_key = get_idempotency_cache_key(request.user.pk, key)
+        data = request.data.lists() if hasattr(request.data, 'lists') else request.data.items()
+        fingerprint = hashlib.sha256(json.dumps(sorted(data), default=str).encode()).hexdigest()
+        stored = cache.get(cache_key)
+        if stored is None:
+            if not cache.add(f'{cache_key}:lock', 1, settings.PAYMENT_IDEMPOTENCY_LOCK_TIMEOUT):
+                return Response({'detail': 'Запрос с этим Idempotency-Key еще обрабатывается'},
+                                status=status.HTTP_409_CONFLICT, headers={'Retry-After': '1'})
+            try:
+                stored = cache.get(cache_key)
+                if stored is None:
+                    stored = self.create_idempotent_payment(request, key, fingerprint, *args, **kwargs)
+                    if stored['status'] < 500:
+                        cache.set(cache_key, stored, settings.PAYMENT_IDEMPOTENCY_TTL)
+                    return Response(stored['data'], status=stored['status'], headers=stored['headers'])
+            finally:
+                cache.delete(f'{cache_key}:lock')
+
+        if stored['fingerprint'] != fingerprint:
+            return Response({'detail': 'Idempotency-Key уже использован с другими параметрами запроса'},
+                            status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        headers = {**stored['headers'], 'Idempotent-Replayed': 'true'}
+        return Response(stored['data'], status=stored['status'], headers=headers)
+
+    def create_idempotent_payment(self, request, key, fingerprint, *args, **kwargs):
+        """Создает платеж или, если платеж с ключом уже есть в БД (ответ пропал из кеша), возвращает его"""
+        payments = Payment.objects.filter(user=request.user, idempotency_key=key)
+        payment = payments.first()
+        if payment is None:
+            try:
+                response = self.create_payment(request, *args, **kwargs)
+            except IntegrityError:
+                # Параллельный запрос с тем же ключом в другом процессе успел создать платеж
+                payment = payments.get()
+        if payment is not None:
+            # Повтор запроса с тем же ключом достраивает сессию, если прошлая попытка не дошла до stripe или упала
+            if payment.checkout_status in (Payment.CHECKOUT_PENDING, Payment.CHECKOUT_FAILED) \
+                    and not self.is_async_checkout():
+                self.create_checkout_session(payment)
+            response = Response(self.get_serializer(payment).data, status=status.HTTP_200_OK)
+        headers = {name: response[name] for name in ('Location', 'Preference-Applied') if response.has_header(name)}
+        return {'fingerprint': fingerprint, 'status': response.status_code, 'data': response.data, 'headers': headers}
+
+    def create_payment(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        if self.is_async_checkout():
+            status_url = request.build_absolute_uri(
+                reverse('materials:payment_status', args=(response.data['id'],))
+            )
+            response.status_code = status.HTTP_202_ACCEPTED
+            response.data['status_url'] = status_url
+            response['Location'] = status_url
+            response['Preference-Applied'] = 'respond-async'
+        return response
 
     def perform_create(self, serializer):
-        payment = serializer.save(user=self.request.user)
-        if payment.course is None and payment.lesson is None:
-            raise ValidationError('Выберите курс или урок для оплаты')
-        elif payment.course is not None and payment.lesson is not None:
-            raise ValidationError('Выберите только один курс или урок для оплаты')
-        else:
-            if payment.course:
-                product = create_product(payment.course)
-            else:
-                product = create_product(payment.lesson)
-        price = create_price(price=payment.summ, product=product)
-        session_id, session_url, payment_method = create_session(price)
-        payment.session_id = session_id
-        payment.payment_link = session_url
-        payment.date = datetime.datetime.now()
-        payment.payment_method = payment_method
-        payment.save()
+        if not self.is_async_checkout():
+            stripe_breaker.raise_if_open()
+        payment = serializer.save(user=self.request.user, date=timezone.now(),
+                                  idempotency_key=self.request.headers.get('Idempotency-Key'))
+        if self.is_async_checkout():
+            transaction.on_commit(lambda: create_payment_checkout.delay(payment.pk))
+            return
+        self.create_checkout_session(payment)
+
+    def create_checkout_session(self, payment):
+        """Создает сессию оплаты в запросе, при ошибке stripe помечает платеж failed и отвечает 503"""
+        try:
+            create_payment_checkout_session(payment)
+        except (StripeUnavailable, stripe.StripeError) as exc:
+            # Как и в задаче create_payment_checkout, платеж без сессии оплаты помечается failed
+            payment.checkout_status = Payment.CHECKOUT_FAILED
+            payment.save(update_fields=['checkout_status'])
+            if isinstance(exc, StripeUnavailable):
+                raise
+            logger.exception('Платеж %s: не удалось создать сессию оплаты', payment.pk)
+            raise StripeUnavailable() from exc
 
 
 class PaymentStatusAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+
     def get(self, *args, **kwargs):
-        payment_pk = self.request.parser_context['kwargs']['pk']
-        payment_id = Payment.objects.get(pk=payment_pk).session_id
-        payment_status, status = get_payment_status(payment_id)
+        payment = get_object_or_404(get_scoped_payments(self.request), pk=self.kwargs['pk'])
+        payment_status, session_status = refresh_payment_status(payment)
         return Response({
+            'checkout_status': payment.checkout_status,
+            'payment_link': payment.payment_link,
             'payment_status': payment_status,
-            'status': status
+            'status': session_status
         })
+
+
+class PaymentWebhookAPIView(APIView):
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def post(self, request, *args, **kwargs):
+        if not settings.STRIPE_WEBHOOK_SECRET:
+            # Без секрета подпись не проверить, stripe повторит доставку, когда секрет будет настроен
+            logger.error('Вебхук stripe отклонен: не задан STRIPE_WEBHOOK_SECRET')
+            return Response({'detail': 'Прием вебхуков не настроен'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        try:
+            event = stripe.Webhook.construct_event(
+                request.body,
+                request.headers.get('Stripe-Signature', ''),
+                settings.STRIPE_WEBHOOK_SECRET
+            )
+        except (ValueError, stripe.SignatureVerificationError):
+            return Response({'detail': 'Неверная подпись вебхука'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'updated': handle_stripe_event(event)})
+
+
+class PaymentCircuitAPIView(APIView):
+    permission_classes = [IsAuthenticated, IsModerator]
+
+    def get(self, *args, **kwargs):
+        return Response(stripe_breaker.get_metrics())